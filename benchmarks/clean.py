@@ -0,0 +1,140 @@
+"""
+Fuzzing and scaling benchmark of utils.clean.clean_doc.
+
+Random documents are assembled from fragments of the kind models produce: text with unescaped specials,
+inline and display math, nested, unclosed and stray environments, tables, verbatim, comments, command
+definitions, duplicated document tags and \\usepackage lines. For each document we check that cleaning is
+idempotent, that command definitions are left as they are, and that the cleaned document has no environment,
+math or escaping errors (utils.validate.structural_errors; brace errors are out of scope). Then we time
+cleaning documents of increasing size, which should scale linearly, both split into paragraphs and as a
+single paragraph (including math opened on every line and never closed).
+
+    python -m benchmarks.clean --documents 2000 --sizes 1 2 4 8
+
+Exits with status 1 if a property fails (printing the smallest failing document found) or if cleaning
+time grows much faster than the document size.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from utils.clean import clean_doc
+from utils.validate import structural_errors
+
+ENVIRONMENTS = ["questions", "parts", "itemize", "enumerate", "solution", "center", "tabular", "align", "equation", "verbatim"]
+WORDS = ["the", "grade", "50%", "R&D", "x_1", "#3", "$5", "cost", "see", "\\textbf{bold}", "\\_", "\\&", "p.", "snake_case"]
+MATH = ["$x_1 + y^2$", "\\(a_b\\)", "\\[ \\sum_i x_i \\]", "$$ f(x) = 1 $$", "$\\{a \\& b\\}$", "\\[ c_d", "$ 1 & 2 $"]
+# definitions whose bodies must be kept as is, although they read as unescaped text
+DEFINITIONS = ["\\newcommand{\\vx}{x_1}", "\\renewcommand*{\\vy}[1][a]{y_{#1} & \\{}", "\\def\\vz#1{z_#1}",
+               "\\DeclareMathOperator*{\\argmax}{arg\\,max_x}", "\\newenvironment{hint}[1]{\\textbf{Hint #1:}}{\\par}",
+               "\\NewDocumentCommand{\\pt}{m}{(#1 points_x)}"]
+PACKAGES = ["amsmath", "amssymb", "graphicx", "amsmath,graphicx", "", "enumitem"]
+
+# structural errors that clean_doc is expected to have repaired
+REPAIRED = ("never closed", "without a matching", "does not match", "before it is closed", "unescaped", "inside math")
+
+def fragment(rng: random.Random) -> str:
+    kind = rng.random()
+    if kind < 0.45:
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+    if kind < 0.6:
+        return rng.choice(MATH)
+    if kind < 0.75:
+        return f"\\begin{{{rng.choice(ENVIRONMENTS)}}}" + ("{ll}" if rng.random() < 0.3 else "")
+    if kind < 0.85:
+        return f"\\end{{{rng.choice(ENVIRONMENTS)}}}"
+    if kind < 0.9:
+        return "a & b \\\\ c & d \\\\"
+    if kind < 0.94:
+        return "% a comment with _ & $"
+    if kind < 0.96:
+        return "\\label{sec_1} \\url{http://example.com/a_b%20c}"
+    if kind < 0.97:
+        return rng.choice(DEFINITIONS)
+    return rng.choice(["\\begin{document}", "\\end{document}", "\\verb|a_b&c|", "\\newcommand{\\f}[1]{#1}"])
+
+def document(rng: random.Random, fragments: int, paragraphs: bool = True) -> str:
+    preamble = "\\documentclass{exam}\n" + "".join(f"\\usepackage{{{rng.choice(PACKAGES)}}}\n" for _ in range(rng.randint(0, 4)))
+    separators = ["\n", " ", "\n\n"] if paragraphs else ["\n", " "]
+    body = "".join(fragment(rng) + rng.choice(separators) for _ in range(fragments))
+    return preamble + "\\begin{document}\n" + body + "\n\\end{document}\n"
+
+def check(doc: str) -> list[str]:
+    """
+    Return the properties that cleaning doc violates.
+    """
+    cleaned = clean_doc(doc)
+    failures = []
+    if clean_doc(cleaned) != cleaned:
+        failures.append("cleaning is not idempotent")
+    errors = [error for error in structural_errors(cleaned) if any(kind in error for kind in REPAIRED)]
+    if errors:
+        failures.append("cleaned document has errors: " + "; ".join(errors[:3]))
+    if any(doc.count(definition) != cleaned.count(definition) for definition in DEFINITIONS):
+        failures.append("a command definition was changed")
+    packages = [line for line in cleaned.splitlines() if line.startswith("\\usepackage")]
+    if len(packages) != len(set(packages)):
+        failures.append("duplicate \\usepackage lines")
+    return failures
+
+def shrink(doc: str) -> str:
+    # drop lines while the document still fails, to report a small example
+    lines = doc.split("\n")
+    i = 0
+    while i < len(lines):
+        candidate = lines[:i] + lines[i + 1:]
+        if check("\n".join(candidate)):
+            lines = candidate
+        else:
+            i += 1
+    return "\n".join(lines)
+
+def fuzz(documents: int, seed: int) -> bool:
+    rng = random.Random(seed)
+    for index in range(documents):
+        doc = document(rng, rng.randint(1, 60))
+        failures = check(doc)
+        if failures:
+            print(f"document {index} (seed {seed}): " + "; ".join(failures))
+            print(shrink(doc))
+            return False
+    print(f"{documents} random documents: all properties hold.")
+    return True
+
+def scaling(sizes: list[float], seed: int) -> bool:
+    rng = random.Random(seed)
+    # a document of many paragraphs, and ones that are a single paragraph (no blank lines), so that every
+    # lookahead bounded by the paragraph could run to the end of the document: random fragments, and math
+    # that is opened on every line and never closed
+    units = {"paragraphs": document(rng, 2000), "one paragraph": document(rng, 2000, paragraphs=False),
+             "unclosed math": "\\begin{document}\n" + "see \\( x_1 at $5 and \\[ 50% off\n" * 2000 + "\\end{document}\n"}
+    ok = True
+    for name, unit in units.items():
+        body = unit[unit.index("\\begin{document}"):unit.rindex("\\end{document}")]
+        rows = []
+        for size in sizes:
+            doc = body * max(1, round(size * 1024 * 1024 / len(body))) + "\\end{document}\n"
+            start = time.perf_counter()
+            clean_doc(doc)
+            seconds = time.perf_counter() - start
+            rows.append((len(doc), seconds))
+            print(f"{name:>13}  {len(doc) / 1024 / 1024:6.1f} MB  {seconds:7.3f} s  {len(doc) / 1024 / 1024 / seconds:7.1f} MB/s")
+        # time per byte may wobble, but shouldn't grow with the size of the document
+        per_byte = [seconds / length for length, seconds in rows]
+        if per_byte[-1] > 3 * per_byte[0]:
+            print(f"Cleaning time ({name}) grows faster than linearly with document size.")
+            ok = False
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuzz utils.clean.clean_doc and measure how it scales.")
+    parser.add_argument("--documents", type=int, default=2000, help="Number of random documents to check.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 2, 4, 8], help="Document sizes to time, in MB.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ok = fuzz(args.documents, args.seed)
+    ok = scaling(args.sizes, args.seed) and ok
+    sys.exit(0 if ok else 1)
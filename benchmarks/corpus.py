@@ -0,0 +1,79 @@
+"""
+Synthetic specification PDFs for benchmarks.
+
+The PDFs are written directly (no dependencies): US Letter pages of Helvetica text laid out like a problem
+set, with numbered problems, lettered parts and point values, so they have a clean text layer and exercise
+both the text-layer and image paths. Generation is deterministic for a given page count.
+
+    python -m benchmarks.corpus benchmarks/corpus 1 5 20 40
+"""
+
+import os
+import random
+import sys
+
+WORDS = ("prove show that the function graph every algorithm runs in time for all integers given set "
+         "suppose let consider compute determine whether probability expected value matrix vector "
+         "bound polynomial tree node edge path cycle distribution random variable independent").split()
+LINES_PER_PAGE = 40
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def _page_lines(rng: random.Random, page: int) -> list[str]:
+    lines = [f"CS 101 Problem Set - page {page}"] if page == 1 else []
+    while len(lines) < LINES_PER_PAGE:
+        problem = rng.randint(1, 99)
+        lines.append(f"Problem {problem} ({rng.choice([5, 10, 15, 20])} points)")
+        for part in "abc"[:rng.randint(1, 3)]:
+            lines.append(f"({part}) " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 14))) + ".")
+            lines.extend(" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(rng.randint(0, 3)))
+        lines.append("")
+    return lines[:LINES_PER_PAGE]
+
+def write_pdf(path: str, pages: int, seed: int = 0) -> None:
+    rng = random.Random(seed * 1000 + pages)
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(1, pages + 1):
+        text = ["BT", "/F1 11 Tf", "14 TL", "72 740 Td"]
+        for line in _page_lines(rng, page):
+            text.append(f"({_escape(line)}) Tj T*")
+        text.append("ET")
+        stream = "\n".join(text)
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {content} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+def build(folder: str, page_counts: list[int]) -> list[str]:
+    """
+    Write one synthetic PDF per page count into folder (if not already there) and return their paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for pages in page_counts:
+        path = os.path.join(folder, f"spec_{pages:03d}p.pdf")
+        if not os.path.exists(path):
+            write_pdf(path, pages)
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    folder, *counts = sys.argv[1:] or ["benchmarks/corpus"]
+    for path in build(folder, [int(c) for c in counts] or [1, 5, 20, 40]):
+        print(path)
@@ -0,0 +1,107 @@
+"""
+Import-time budget for the CLI.
+
+Batch scripts call the CLI thousands of times, so its cold start matters. For each case we start a fresh
+interpreter with `python -X importtime`, add up the time spent importing modules, and check that no heavy
+dependency was imported in a path that doesn't need it:
+
+- `--help`: argument parsing only
+- cached run: `python -m spec_to_tex <pdf>` on a synthetic PDF (see benchmarks/corpus.py) whose API
+  responses are all cached. Its pages have a text layer, so nothing is rasterized and nothing is sent:
+  requests, aiohttp, PIL, pdf2image and LlamaParse must not load
+- cached run, images: the same with --no-text-layer. The pages are still rasterized and encoded to look
+  them up in the cache, so PIL and pdf2image load, but requests, aiohttp and LlamaParse must not
+
+The cache is filled first by a run against the stub server (see benchmarks/stub_server.py), in a temporary
+directory; a measured run that sends any request counts as a failure. The cached runs need poppler
+(pdftotext, and pdftoppm for images), like the CLI itself.
+
+    python -m benchmarks.importtime --budget-ms 400
+
+Exits with status 1 if a case goes over budget or imports a module it shouldn't.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus, stub_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NETWORK = ["requests", "aiohttp", "llama_parse", "nest_asyncio"]
+HEAVY = NETWORK + ["PIL", "pdf2image", "pymupdf"]
+
+CASES = [
+    ("--help", ["-m", "spec_to_tex", "--help"], HEAVY + ["dotenv", "pydantic", "spec_to_tex.conversion"], False),
+    ("cached run", ["-m", "spec_to_tex", "spec.pdf", "-o", "spec.tex"], HEAVY, True),
+    ("cached run, images", ["-m", "spec_to_tex", "spec.pdf", "-o", "spec.tex", "--no-text-layer"],
+     NETWORK + ["pymupdf"], True),
+]
+
+def measure(arguments: list[str], folder: str, env: dict) -> tuple[float, float, set[str], str]:
+    """
+    Run python -X importtime with arguments in folder. Returns (import seconds, wall seconds, imported modules, errors).
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", *arguments], capture_output=True, text=True,
+                            cwd=folder, env=env)
+    wall = time.perf_counter() - start
+
+    total, modules, errors = 0, set(), []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue  # the header
+        name = fields[2].rstrip()
+        modules.add(name.strip())
+        if not name.startswith("  "):
+            # top-level imports; their cumulative times include everything they import
+            total += int(fields[1])
+    if not result.returncode:
+        return total / 1e6, wall, modules, ""
+    return total / 1e6, wall, modules, "\n".join(errors + result.stdout.splitlines()) or f"exit status {result.returncode}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the CLI's import time against a budget.")
+    parser.add_argument("--budget-ms", type=float, default=400, help="Maximum total import time per case, in milliseconds.")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per case; the fastest counts, to discount a cold disk cache.")
+    parser.add_argument("--pages", type=int, default=2, help="Pages in the synthetic PDF the cached runs convert.")
+    args = parser.parse_args()
+
+    server = stub_server.start()
+    env = dict(os.environ, PYTHONPATH=ROOT, OPENAI_BASE_URL=server.base_url, OPENAI_API_KEY="stub")
+    ok = True
+    with tempfile.TemporaryDirectory() as folder:
+        corpus.write_pdf(os.path.join(folder, "spec.pdf"), args.pages)
+        print(f"{'case':<20} {'imports ms':>10} {'wall ms':>8}  result")
+        for name, arguments, forbidden, cached in CASES:
+            problems = []
+            if cached:
+                # fill the cache (cache/ in folder); the measured runs must then not send anything
+                warmup = subprocess.run([sys.executable, *arguments], capture_output=True, text=True, cwd=folder, env=env)
+                if warmup.returncode:
+                    output = (warmup.stderr + warmup.stdout).strip().splitlines()
+                    problems.append("warm-up failed: " + (output[-1] if output else f"exit status {warmup.returncode}"))
+            sent = server.stats["requests"]
+            runs = [measure(arguments, folder, env) for _ in range(args.runs)]
+            imports, wall, modules, errors = min(runs)
+            if errors:
+                problems.append("failed: " + errors.splitlines()[-1])
+            if server.stats["requests"] > sent:
+                problems.append(f"sent {server.stats['requests'] - sent} requests")
+            if imports * 1000 > args.budget_ms:
+                problems.append(f"over the {args.budget_ms:g} ms budget")
+            loaded = [module for module in forbidden if module in modules]
+            if loaded:
+                problems.append("imports " + ", ".join(loaded))
+            ok = ok and not problems
+            print(f"{name:<20} {imports * 1000:>10.1f} {wall * 1000:>8.1f}  {'; '.join(problems) or 'ok'}")
+    server.shutdown()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,197 @@
+"""
+End-to-end benchmark of the conversion pipeline against a local stub of the chat-completions endpoint.
+
+For each synthetic PDF in the corpus (see benchmarks/corpus.py), the pipeline runs twice in a fresh
+subprocess: once with an empty response cache ("cold") and once with the cache it left behind ("warm").
+For each run we report wall time, time spent per stage (summed over threads, so stages can add up to more
+than the wall time with concurrency), peak RSS of the process and its children, and bytes sent to the API.
+
+    python -m benchmarks.run --pages 1 5 20 40 --latency 0.5 --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --pages 1 5 20 40 --latency 0.5 --baseline benchmarks/baseline.json
+
+Options after `--` are passed to from_openai as keyword arguments, e.g. `-- chunk_size=4 workers=8`. With
+`window` set, pages are rasterized as they are consumed, so peak RSS should stay flat as page counts grow:
+
+    python -m benchmarks.run --pages 20 100 200 --images -- window=4 max_memory=67108864
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus, stub_server
+
+STAGES = ["text layer", "rasterize", "encode", "cache lookup", "generate", "analyze", "fix", "clean"]
+METRICS = ["wall", "peak_rss_mb", "bytes_sent", "requests"]
+
+def run_case(path: str, images: bool, options: dict) -> dict:
+    """
+    Run the pipeline once on path in this process and return its measurements.
+    Called in a subprocess (see main), with OPENAI_BASE_URL pointing at the stub server.
+    """
+    import functools
+    import resource
+    import threading
+    from collections import defaultdict
+
+    import pdf2image
+    from spec_to_tex import conversion, rasterize, textlayer
+    from spec_to_tex.wrappers import openai
+    from utils import cache
+
+    timings = defaultdict(float)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def timed(stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with lock:
+                    timings[stage] += time.perf_counter() - start
+        return wrapper
+
+    def generating(func):
+        # API calls made outside of generation are fix calls
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            local.generating = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                local.generating = False
+        return wrapper
+
+    get_response = openai.Client.get_response
+    fix_response = timed("fix", get_response)
+
+    def client_get_response(self, *args, **kwargs):
+        if getattr(local, "generating", False):
+            return get_response(self, *args, **kwargs)
+        return fix_response(self, *args, **kwargs)
+
+    pdf2image.convert_from_path = timed("rasterize", pdf2image.convert_from_path)
+    rasterize.encode_image = timed("encode", rasterize.encode_image)
+    textlayer.extract_text = timed("text layer", textlayer.extract_text)
+    textlayer.image_counts = timed("text layer", textlayer.image_counts)
+    cache.get = timed("cache lookup", cache.get)
+    conversion._generate = generating(timed("generate", conversion._generate))
+    conversion.validate = timed("analyze", conversion.validate)
+    conversion.clean_doc = timed("clean", conversion.clean_doc)
+    openai.Client.get_response = client_get_response
+
+    start = time.perf_counter()
+    if options.get("window"):
+        # windowed conversion rasterizes pages as it consumes them
+        pages = rasterize.stream_encoded_pages(path) if images else textlayer.stream_pages(path)
+    elif images:
+        pages = list(rasterize.iter_encoded_pages(path))
+    else:
+        pages = textlayer.load_pages(path)
+    conversion.from_openai(pages, **options)
+    wall = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {"wall": wall, "peak_rss_mb": peak / 1024, "stages": {stage: timings[stage] for stage in STAGES}}
+
+def _stub_stats(server: stub_server.StubServer) -> dict:
+    with server.lock:
+        return dict(server.stats)
+
+def _parse_options(values: list[str]) -> dict:
+    options = {}
+    for value in values:
+        key, _, raw = value.partition("=")
+        try:
+            options[key] = json.loads(raw)
+        except ValueError:
+            options[key] = raw
+    return options
+
+def print_results(results: dict, baseline: dict | None = None) -> None:
+    header = f"{'case':<22}" + "".join(f"{m:>14}" for m in METRICS) + "".join(f"{s:>13}" for s in STAGES)
+    print(header)
+    for case, result in results.items():
+        row = f"{case:<22}"
+        for metric in METRICS:
+            value = result[metric]
+            cell = f"{value:.2f}" if isinstance(value, float) else str(value)
+            if baseline and case in baseline and baseline[case].get(metric):
+                cell += f" {100 * (value - baseline[case][metric]) / baseline[case][metric]:+.0f}%"
+            row += f"{cell:>14}"
+        row += "".join(f"{result['stages'][stage]:>13.3f}" for stage in STAGES)
+        print(row)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the conversion pipeline against a local stub server.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 5, 20], help="Page counts of the synthetic PDFs.")
+    parser.add_argument("--corpus", default=os.path.join("benchmarks", "corpus"), help="Where to write the synthetic PDFs.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub server response latency, in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Stub server latency jitter, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests the stub server fails with 429/500.")
+    parser.add_argument("--responses", default=None, help="A JSON file with a list of canned response contents.")
+    parser.add_argument("--failing", action="store_true", help="Have the stub generate documents that need a fix.")
+    parser.add_argument("--images", action="store_true", help="Send every page as an image (skip the text-layer fast path).")
+    parser.add_argument("--baseline", default=None, help="Compare against the results saved in this file.")
+    parser.add_argument("--save-baseline", default=None, help="Save the results to this file.")
+    parser.add_argument("--case", nargs=2, metavar=("PDF", "OPTIONS"), help=argparse.SUPPRESS)
+    parser.add_argument("--cache-dir", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("options", nargs="*", help="key=value keyword arguments for from_openai.")
+    args = parser.parse_args()
+
+    if args.case:
+        # child process: run a single case and report it on stdout
+        from utils import cache
+
+        cache.CACHE_DIR = args.cache_dir
+        path, options = args.case
+        print(json.dumps(run_case(path, args.images, json.loads(options))))
+        return
+
+    responses = [stub_server.FAILING_DOCUMENT] if args.failing else None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+    server = stub_server.start(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, responses=responses)
+    options = _parse_options(args.options)
+
+    results = {}
+    for path in corpus.build(args.corpus, args.pages):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with tempfile.TemporaryDirectory(prefix="spec-to-tex-bench-") as folder:
+            env = dict(os.environ, OPENAI_BASE_URL=server.base_url, OPENAI_API_KEY="stub")
+            for run in ("cold", "warm"):
+                before = _stub_stats(server)
+                command = [sys.executable, "-m", "benchmarks.run", "--case", path, json.dumps(options),
+                           "--cache-dir", os.path.join(folder, "cache")] + (["--images"] if args.images else [])
+                completed = subprocess.run(command, env=env, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(completed.stderr, file=sys.stderr)
+                    sys.exit(f"Benchmark case {name}/{run} failed.")
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                after = _stub_stats(server)
+                result["bytes_sent"] = after["bytes_received"] - before["bytes_received"]
+                result["requests"] = after["requests"] - before["requests"]
+                results[f"{name}/{run}"] = result
+    server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Local stub of the OpenAI chat-completions endpoint and the LlamaParse parsing API, for benchmarks and for
+trying the pipeline offline.
+
+Responds to POST /v1/chat/completions after a configurable latency, fails a configurable fraction of
+requests with 429 or 500 (with a Retry-After header), and answers with canned JSON content in the shape of
+the schema in the request's system prompt, streamed as server-sent events when the request asks for it:
+generation requests get a TeXDocument (CANNED_DOCUMENT, or the --responses cycle), fix requests get TeXFix
+edits that replace any line of FAILING_DOCUMENT's known errors shown in the excerpts. GET /stats returns
+request and byte counters.
+
+For LlamaParse, POST /api/parsing/upload creates a job for the uploaded PDF, which stays PENDING until the
+latency has passed; GET /api/parsing/job/<id>/result/json then returns one complete LaTeX document per page,
+each with its own preamble, as the real service does.
+
+    python -m benchmarks.stub_server --port 8765 --latency 0.5 --error-rate 0.05
+    python -m benchmarks.stub_server --port 8765 --failing   # every document needs a fix
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python -m spec_to_tex documents/hw.pdf
+    LLAMA_CLOUD_BASE_URL=http://127.0.0.1:8765 python -m spec_to_tex documents/hw.pdf --mode llama
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_DOCUMENT = {
+    "packages_needed": ["amsmath", "amssymb"],
+    "document_body": "\\begin{questions}\n\\question Prove that $\\sum_{i=1}^n i = \\frac{n(n+1)}{2}$.\n"
+                     "\\begin{solution}\n\n\\end{solution}\n\\end{questions}",
+}
+
+# a document that fails validation (a ^ outside math, which clean_doc leaves alone), and the fix of each broken line
+BROKEN_LINE = "\\question Compute 2^10 by hand."
+FAILING_DOCUMENT = {
+    "packages_needed": ["amsmath", "amssymb"],
+    "document_body": f"\\begin{{questions}}\n{BROKEN_LINE}\n\\begin{{solution}}\n\n\\end{{solution}}\n\\end{{questions}}",
+}
+FIXES = {BROKEN_LINE: "\\question Compute $2^{10}$ by hand."}
+
+# a numbered line of the excerpts in a fix request
+EXCERPT_LINE = re.compile(r"^\s*(\d+): (.*)$", re.MULTILINE)
+
+CANNED_PAGE = """```latex
+\\documentclass{{exam}}
+\\usepackage{{amsmath}}
+\\usepackage{{amssymb}}
+\\begin{{document}}
+\\section*{{Page {page}}}
+\\begin{{questions}}
+\\question Prove that $\\sum_{{i=1}}^n i = \\frac{{n(n+1)}}{{2}}$.
+\\end{{questions}}
+\\end{{document}}
+```"""
+
+# a PDF page object; `\b` keeps the page tree's `/Type /Pages` from matching
+PDF_PAGE = re.compile(rb"/Type\s*/Page\b")
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 responses: list[dict] | None = None, chunk_size: int = 16):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.responses = itertools.cycle(responses or [CANNED_DOCUMENT])
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "bytes_received": 0, "bytes_sent": 0}
+        self.jobs = {}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def llama_base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def fail(self) -> bool:
+        return random.random() < self.error_rate
+
+    def count(self, **increments: int) -> None:
+        with self.lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def next_content(self) -> str:
+        with self.lock:
+            return json.dumps(next(self.responses))
+
+def _text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content
+
+def canned_fix(prompt: str) -> dict:
+    """
+    Return TeXFix edits replacing each line of the excerpts in a fix prompt that FIXES knows how to fix.
+    """
+    edits = []
+    for match in EXCERPT_LINE.finditer(prompt):
+        line = match.group(2).strip()
+        if line in FIXES:
+            number = int(match.group(1))
+            edits.append({"first_line": number, "last_line": number, "replacement": FIXES[line]})
+    return {"edits": edits}
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json", headers: dict | None = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(bytes_sent=len(body))
+
+    def _send_failure(self) -> None:
+        self.server.count(errors=1)
+        status = random.choice([429, 500])
+        self._send(status, json.dumps({"error": {"message": "stubbed failure"}}).encode(), headers={"Retry-After": "0"})
+
+    def do_GET(self) -> None:
+        path = self.path.rstrip("/")
+        if path == "/stats":
+            with self.server.lock:
+                stats = json.dumps(self.server.stats).encode()
+            self._send(200, stats)
+        elif path.startswith("/api/parsing/job/"):
+            self.server.count(requests=1)
+            self._llama_job(path[len("/api/parsing/job/"):])
+        else:
+            self._send(404, b'{"error": "not found"}')
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.count(requests=1, bytes_received=len(body))
+        if self.path.rstrip("/") == "/api/parsing/upload":
+            self._llama_upload(body)
+            return
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send(404, b'{"error": "not found"}')
+            return
+
+        time.sleep(self.server.delay())
+        if self.server.fail():
+            self._send_failure()
+            return
+
+        request = json.loads(body or b"{}")
+        messages = request.get("messages", [])
+        system = next((_text(message) for message in messages if message.get("role") == "system"), "")
+        if '"title": "TeXFix"' in system:
+            content = json.dumps(canned_fix("\n".join(_text(message) for message in messages if message.get("role") == "user")))
+        else:
+            content = self.server.next_content()
+        usage = {"prompt_tokens": len(body) // 4, "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if request.get("stream"):
+            self._stream(content, usage)
+            return
+        response = {
+            "id": "chatcmpl-stub", "object": "chat.completion", "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+        self._send(200, json.dumps(response).encode())
+
+    def _stream(self, content: str, usage: dict) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        size = self.server.chunk_size
+        for i in range(0, len(content), size):
+            event = {"choices": [{"index": 0, "delta": {"content": content[i:i + size]}}]}
+            data = f"data: {json.dumps(event)}\n\n".encode()
+            self.wfile.write(data)
+            self.wfile.flush()
+            self.server.count(bytes_sent=len(data))
+        self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode())
+        self.close_connection = True
+
+    def _llama_upload(self, body: bytes) -> None:
+        if self.server.fail():
+            self._send_failure()
+            return
+        # the multipart body contains the PDF as is, so its page objects can be counted without parsing the form
+        job_id = str(uuid.uuid4())
+        with self.server.lock:
+            self.server.jobs[job_id] = {"ready": time.monotonic() + self.server.delay(), "pages": max(1, len(PDF_PAGE.findall(body)))}
+        self._send(200, json.dumps({"id": job_id, "status": "PENDING"}).encode())
+
+    def _llama_job(self, route: str) -> None:
+        job_id, _, rest = route.partition("/")
+        with self.server.lock:
+            job = self.server.jobs.get(job_id)
+        if job is None or rest not in ("", "result/json"):
+            self._send(404, b'{"detail": "Job not found"}')
+            return
+        if self.server.fail():
+            self._send_failure()
+            return
+        done = time.monotonic() >= job["ready"]
+        if not rest:
+            self._send(200, json.dumps({"id": job_id, "status": "SUCCESS" if done else "PENDING"}).encode())
+        elif not done:
+            self._send(400, b'{"detail": "Job not completed yet"}')
+        else:
+            pages = [{"page": page, "md": CANNED_PAGE.format(page=page)} for page in range(1, job["pages"] + 1)]
+            self._send(200, json.dumps({"pages": pages}).encode())
+
+def start(port: int = 0, **options) -> StubServer:
+    """
+    Start a stub server on a background thread (port 0 picks a free port) and return it.
+    """
+    server = StubServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stub of the OpenAI chat-completions endpoint and the LlamaParse API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before responding.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random deviation from the latency, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429 or 500.")
+    parser.add_argument("--responses", default=None, help="A JSON file with a list of response contents to cycle through.")
+    parser.add_argument("--failing", action="store_true", help="Answer generation requests with a document that needs a fix.")
+    args = parser.parse_args()
+
+    responses = [FAILING_DOCUMENT] if args.failing else None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+    server = StubServer(("127.0.0.1", args.port), latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, responses=responses)
+    print(f"Serving stub chat completions at {server.base_url} and stub LlamaParse at {server.llama_base_url}")
+    server.serve_forever()
@@ -1,9 +1,6 @@
 import argparse
-import base64
-import shutil
-from pdf2image import convert_from_path
-from dotenv import load_dotenv
 import os
+from spec_to_tex.rasterize import DEFAULT_DPI, DEFAULT_QUALITY
 
 """
 Given one specification file, which may be a homework assignment, project spec, etc.
@@ -11,66 +8,207 @@ Given one specification file, which may be a homework assignment, project spec,
 We convert the specification to a LaTeX template.
 
 We assume there are places in the specification that are meant to be filled in by the user.
+
+Only what argument parsing needs is imported up front; everything else is imported in the code path that
+uses it, so that --help, --clear-cache and fully cached runs start quickly (see benchmarks/importtime.py).
 """
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="run.py", description="Convert a specification to a LaTeX template.")
-    parser.add_argument("path", help="The path to the specification file.")
+    parser.add_argument("path", nargs="?", help="The path to the specification file. A directory or glob pattern (quote it) converts every matching PDF, writing <name>.tex for each.")
+    parser.add_argument("-o", "--output", help="Where to write the generated TeX ('-' for stdout).", default="output.tex")
     parser.add_argument("-m", "--mode", 
-                        help="The mode to use for conversion. Options are 'openai', 'llama', and 'structure'. openai uses GPT4V, llama uses LlamaParse, and structure uses a pipeline of OCR and vision transformer image layout analysis to programatically build the TeX.", 
+                        help="The mode to use for conversion. Options are 'openai', 'llama', and 'structure'. openai uses GPT4V, llama uses LlamaParse, and structure builds the TeX locally, with no API calls, from the text and layout of the PDF.", 
                         default="openai",
                         choices=["openai", "llama", "structure"])
     parser.add_argument("-v", "--verbose", help="Increase output verbosity.", action="store_true", default=False)
     parser.add_argument("-oa", "--openai", help="The OpenAI API key to use. If not provided, we assume it is stored as an environment variable.", default=None)
     parser.add_argument("--clear-cache", help="Clear the cache of API responses.", action="store_true", default=False)
+    parser.add_argument("--pages", help="Convert only these pages, e.g. '1-3,7,10-' (1-based, inclusive; an open end means the last page).", default=None)
+    parser.add_argument("--window", help="For OpenAI mode: convert the document in windows of up to this many pages, rasterizing each window only when it is submitted, so memory use stays flat however long the document is.", type=int, default=None)
+    parser.add_argument("--max-memory", help="For --window: roughly how much memory (in MB) the pages being converted may take up. Windows are cut short, and wait for earlier windows to finish, to stay under it.", type=int, default=256)
+    parser.add_argument("--dpi", help="The resolution at which to rasterize the pages of the document.", type=int, default=DEFAULT_DPI)
+    parser.add_argument("--jpeg-quality", help="The JPEG quality (1-95) used to encode the rasterized pages.", type=int, default=DEFAULT_QUALITY)
+    parser.add_argument("--no-text-layer", help="Always send page images, even for pages whose extracted text is good enough to send instead.", action="store_true", default=False)
+    parser.add_argument("--preprocess", help="Crop margins, convert to grayscale, downscale, and drop blank pages before sending page images, to cut image tokens. With -v, prints the estimated savings (with --window, once every page has been rasterized).", action="store_true", default=False)
+    parser.add_argument("--tile", help="With --preprocess: send only the regions of each page that have content, as separate images, when that is cheaper.", action="store_true", default=False)
+    parser.add_argument("--chunk-size", help="For OpenAI mode: convert the document in chunks of this many pages, concurrently. By default the whole document is converted in one request.", type=int, default=None)
+    parser.add_argument("--workers", help="For OpenAI mode: the maximum number of chunks converted concurrently.", type=int, default=4)
+    parser.add_argument("--compile", help="For OpenAI mode: also check the generated TeX by compiling it in a sandbox (requires pdflatex or tectonic).", action="store_true", default=False)
+    parser.add_argument("--engine", help="The TeX engine used by --compile.", choices=["pdflatex", "tectonic"], default=None)
+    parser.add_argument("--stream", help="For OpenAI mode: stream the generation, writing partial TeX to <output>.partial.tex as it arrives. The final document is written to the output when conversion completes.", action="store_true", default=False)
+    parser.add_argument("--incremental", help="For OpenAI mode: convert page by page, keeping a manifest next to the output so that re-converting a revised document only regenerates the pages that changed.", action="store_true", default=False)
+    parser.add_argument("--shared-pages", help="For OpenAI mode: convert page by page, reusing the TeX generated for matching pages of previously converted documents (cover pages, honor codes, ...) from an index in the cache.", action="store_true", default=False)
+    parser.add_argument("--similarity", help="For --shared-pages: the number of bits (of 1024) in which the perceptual hashes of two page images may differ for them to be compared. Candidates are reused only if a finer thumbnail matches too; text pages must match exactly.", type=int, default=16)
+    parser.add_argument("--models", help="For OpenAI mode: comma-separated models to generate with, cheapest first. Each document (or chunk) is regenerated with the next model only if the output fails to parse or check.", default=None)
+    parser.add_argument("--fix-model", help="For OpenAI mode: the model asked to fix documents that fail checks. Defaults to the first (cheapest) of --models.", default=None)
+    parser.add_argument("--trace", help="Write a trace of pipeline stages and API calls (latency, tokens, cache hits, retries) to this file as JSON lines, and print a summary at the end.", default=None)
+    parser.add_argument("-j", "--jobs", help="For batch conversion: the number of documents converted concurrently.", type=int, default=4)
+    parser.add_argument("--output-dir", help="For batch conversion: where to write the .tex files. Defaults to next to each input.", default=None)
+    parser.add_argument("--force", help="For batch conversion: reconvert inputs even if their output is up to date.", action="store_true", default=False)
+    parser.add_argument("--serve", metavar="ADDRESS", help="Instead of converting a file, run a conversion service on ADDRESS (host:port, or unix:/path/to/socket) that accepts PDF uploads. --jobs sets the number of documents converted concurrently. Can't be combined with --trace or --incremental.", default=None)
+    parser.add_argument("--queue-size", help="For --serve: the maximum number of queued jobs before uploads are rejected.", type=int, default=64)
     # parser.add_argument("-p", "--precise", help="For OpenAI mode: use significantly more API calls to get more precise results. Use when normal output is inadequate or incorrect.", 
     #                     action="store_true", default=False)
 
     args = parser.parse_args()
+    if args.clear_cache:
+        from utils.cache import clear_cache
+        clear_cache()
+        if args.path is None and args.serve is None:
+            exit(0)
 
-    if args.openai is None:
+    if args.path is None and args.serve is None:
+        parser.error("a path is required unless --serve or --clear-cache is given")
+    if args.serve and (args.trace or args.incremental):
+        parser.error("--serve can't be combined with --trace or --incremental, which write files next to a single output")
+    if args.window and (args.incremental or args.shared_pages):
+        parser.error("--window can't be combined with --incremental or --shared-pages, which convert page by page")
+    if args.pages and args.mode == "llama":
+        parser.error("--pages is not supported in llama mode, which uploads the whole document")
+
+    page_ranges = None
+    if args.pages:
+        from spec_to_tex.rasterize import parse_page_range
+        try:
+            page_ranges = parse_page_range(args.pages)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.openai is not None:
+        os.environ["OPENAI_API_KEY"] = args.openai
+    elif args.mode != "structure" and {"openai": "OPENAI_API_KEY", "llama": "LLAMA_CLOUD_API_KEY"}[args.mode] not in os.environ:
+        from dotenv import load_dotenv
         load_dotenv()
-        API_KEY = os.getenv("OPENAI_API_KEY")
-    else:
-        API_KEY = args.api_key
 
-    os.environ["OPENAI_API_KEY"] = API_KEY
+    from utils import trace
+    trace.enable(bool(args.trace))
 
-    if args.clear_cache:
-        from utils.cache import clear_cache
-        clear_cache()
+    def load(path: str) -> list:
+        if args.mode == "llama":
+            # LlamaParse takes the PDF itself, so there is nothing to rasterize
+            return [path]
+        selected = None
+        if page_ranges:
+            from spec_to_tex.rasterize import page_count, select_pages
+            selected = select_pages(page_ranges, page_count(path))
+        if args.mode == "structure":
+            # structure mode works from the text layer, so extract lines instead of rasterizing
+            from spec_to_tex.structure import extract_pages
+            pages = extract_pages(path)
+            return pages if selected is None else [pages[number - 1] for number in selected]
+        stats = {}
+        # with --window, pages are rasterized as conversion consumes them (and stats fill in as they are)
+        options = dict(dpi=args.dpi, quality=args.jpeg_quality, preprocess=args.preprocess, tile=args.tile, stats=stats, pages=selected)
+        if args.no_text_layer:
+            from spec_to_tex.rasterize import iter_encoded_pages, stream_encoded_pages
+            pages = stream_encoded_pages(path, **options) if args.window else list(iter_encoded_pages(path, **options))
+        else:
+            from spec_to_tex.textlayer import load_pages, stream_pages
+            pages = (stream_pages if args.window else load_pages)(path, verbose=args.verbose, **options)
+
+        def report_stats() -> None:
+            if args.preprocess and args.verbose and stats:
+                print(f"{path}: estimated image tokens {stats['tokens_before']} before preprocessing, {stats['tokens_after']} after "
+                      f"({stats['blank_pages']} blank pages dropped).")
+
+        if not args.window:
+            report_stats()
+            return pages
+        from spec_to_tex.rasterize import PageStream
+        stream = pages
+
+        def reported():
+            # the stats are complete once conversion has taken the last page
+            yield from stream
+            report_stats()
+        return PageStream(len(stream), reported)
+
+    def rasterize(path: str) -> list:
+        with trace.span("rasterize", path=path, mode=args.mode) as attributes:
+            pages = load(path)
+            attributes["pages"] = len(pages)
+            return pages
+
+    def report_trace() -> None:
+        if args.trace:
+            trace.write_jsonl(args.trace)
+            print(trace.summary())
+
+    page_index = None
+    if args.shared_pages and args.mode == "openai":
+        # one index shared by every document converted in this run
+        from spec_to_tex.pageindex import PageIndex
+        page_index = PageIndex(threshold=args.similarity)
+
+    def convert(encoded_images: list, output: str, stream=None) -> str:
+        if args.mode == "openai":
+            from spec_to_tex.conversion import from_openai
+            from spec_to_tex.manifest import manifest_path
+
+            def run(stream=None) -> str:
+                return from_openai(encoded_images, verbose=args.verbose, chunk_size=args.chunk_size, workers=args.workers,
+                                   compile_check=args.compile, engine=args.engine,
+                                   manifest=manifest_path(output) if args.incremental else None, stream=stream,
+                                   models=args.models.split(",") if args.models else None, fix_model=args.fix_model,
+                                   page_index=page_index, window=args.window, max_memory=args.max_memory * 1024 * 1024)
+
+            if stream is not None or not args.stream:
+                return run(stream=stream)
+            from spec_to_tex.progressive import ProgressiveWriter
+            with ProgressiveWriter(output) as writer:
+                return run(stream=writer.write)
+        elif args.mode == "llama":
+            from spec_to_tex.conversion import from_llama
+            return from_llama(encoded_images[0], verbose=args.verbose)
+        else:
+            from spec_to_tex.conversion import from_structure
+            return from_structure(encoded_images, verbose=args.verbose)
 
-    try:
-        images = convert_from_path(args.path)
-        if not os.path.exists("tmp"):
-            os.mkdir("tmp")
-        for i, image in enumerate(images):
-                image.save(f"tmp/image_{i}.jpg", "JPEG")
-        if args.verbose:
-            print(f"Found {len(images)} pages in the PDF.")
-    except:
-        print(f"Error opening file at path {args.path}.")
-        exit(1)
-
-    def encode_image(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-
-    encoded_images = [encode_image(os.path.join("tmp", image)) for image in os.listdir("tmp")]
-    shutil.rmtree("tmp")
-
-    # generate the latex
     if args.mode == "openai":
-        from spec_to_tex.conversion import from_openai
-        generated_tex: str = from_openai(encoded_images, verbose=args.verbose)
-    elif args.mode == "llama":
-        # from spec_to_tex.conversion import from_llama
-        # generated_tex: str = from_llama(encoded_images)
-        raise NotImplementedError("The 'llama' mode is not yet implemented.")
-    else:
-        raise NotImplementedError("The 'structure' mode is not yet implemented.")
+        # room in the connection pool for every request in flight: jobs documents, each with up to workers requests
+        from spec_to_tex.wrappers.openai import configure
+        configure(pool_size=args.jobs * args.workers)
+
+    if args.serve:
+        from spec_to_tex.service import serve
+        if args.mode == "openai":
+            # import the conversion pipeline and open the API session before the first job arrives
+            import spec_to_tex.conversion  # noqa: F401
+            from spec_to_tex.wrappers.openai import session
+            session()
+        serve(args.serve, rasterize, convert, workers=args.jobs, queue_size=args.queue_size)
+        exit(0)
+
+    from spec_to_tex.batch import is_batch
+    if is_batch(args.path):
+        from spec_to_tex.batch import find_inputs, print_summary, run_batch
+        inputs = find_inputs(args.path)
+        if not inputs:
+            print(f"No PDFs found at {args.path}.")
+            exit(1)
+        results = run_batch(inputs, rasterize, convert, jobs=args.jobs, output_dir=args.output_dir, force=args.force, verbose=args.verbose)
+        print_summary(results)
+        report_trace()
+        exit(0 if all(row["status"] in ("ok", "up to date") for row in results) else 1)
+
+    with trace.span("document", path=args.path):
+        try:
+            encoded_images = rasterize(args.path)
+            if args.verbose:
+                print(f"Found {len(encoded_images)} pages in the PDF.")
+        except Exception:
+            print(f"Error opening file at path {args.path}.")
+            exit(1)
+
+        # generate the latex
+        generated_tex: str = convert(encoded_images, args.output)
 
     # save the tex
-    with open("output.tex", "w") as f:
-        f.write(generated_tex)
+    if args.output == "-":
+        print(generated_tex)
+    else:
+        with open(args.output, "w") as f:
+            f.write(generated_tex)
+    report_trace()
 
-    ####
+    ####
\ No newline at end of file
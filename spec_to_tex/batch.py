@@ -0,0 +1,89 @@
+"""
+Batch conversion of many specification documents at once.
+
+Documents are converted concurrently by a pool of `jobs` threads. Rasterization runs on a separate pool
+sized to the number of CPUs, so many documents waiting on the API don't oversubscribe the machine with
+pdftoppm processes, and all API requests share the pooled HTTP session of the OpenAI (or LlamaParse) wrapper.
+"""
+
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from utils import trace
+
+def is_batch(path: str) -> bool:
+    return os.path.isdir(path) or glob.has_magic(path)
+
+def find_inputs(path: str) -> list[str]:
+    """
+    Return the PDFs in a directory, or matching a glob pattern, in sorted order.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "*.pdf")
+    return sorted(p for p in glob.glob(path) if os.path.isfile(p))
+
+def output_path(input_path: str, output_dir: str | None = None) -> str:
+    name = os.path.splitext(os.path.basename(input_path))[0] + ".tex"
+    return os.path.join(output_dir or os.path.dirname(input_path), name)
+
+def is_up_to_date(input_path: str, output: str) -> bool:
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(input_path)
+
+def run_batch(inputs: list[str], rasterize: Callable[[str], list], convert: Callable[[list, str], str],
+              jobs: int = 4, output_dir: str | None = None, force: bool = False, verbose: bool = False) -> list[dict]:
+    """
+    Convert each input to `<name>.tex` (next to the input, or in output_dir) and return one summary row per input.
+
+    `rasterize` maps a path to the pages passed to `convert`, which also gets the output path and returns the TeX.
+    Inputs whose output is newer than the input are skipped unless force is set.
+    """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as rasterize_pool:
+
+        def process(input_path: str) -> dict:
+            output = output_path(input_path, output_dir)
+            row = {"input": input_path, "output": output, "pages": None, "rasterize": 0.0, "convert": 0.0}
+            if not force and is_up_to_date(input_path, output):
+                row["status"] = "up to date"
+                return row
+
+            try:
+                with trace.span("document", path=input_path):
+                    start = time.perf_counter()
+                    pages = rasterize_pool.submit(trace.bind(rasterize), input_path).result()
+                    row["pages"] = len(pages)
+                    row["rasterize"] = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    tex = convert(pages, output)
+                    row["convert"] = time.perf_counter() - start
+
+                with open(output, "w") as f:
+                    f.write(tex)
+                row["status"] = "ok"
+            except Exception as e:
+                row["status"] = f"failed: {type(e).__name__}: {e}"
+
+            if verbose:
+                print(f"{input_path}: {row['status']}")
+            return row
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(process, inputs))
+
+def print_summary(results: list[dict]) -> None:
+    width = max([len("document")] + [len(row["input"]) for row in results])
+    print(f"{'document':<{width}}  {'pages':>5}  {'raster s':>8}  {'convert s':>9}  status")
+    for row in results:
+        pages = "" if row["pages"] is None else row["pages"]
+        print(f"{row['input']:<{width}}  {pages:>5}  {row['rasterize']:>8.2f}  {row['convert']:>9.2f}  {row['status']}")
+
+    converted = sum(row["status"] == "ok" for row in results)
+    skipped = sum(row["status"] == "up to date" for row in results)
+    failed = len(results) - converted - skipped
+    print(f"{converted} converted, {skipped} up to date, {failed} failed.")
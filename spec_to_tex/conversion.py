@@ -7,54 +7,23 @@ Draws on abstractions defined in other modules to form a pipeline for the conver
 
 from pydantic import BaseModel, Field, ValidationError
 from utils.clean import clean_doc
+from utils.jsonstream import JSONStringStream
+from utils.validate import validate
+from utils import trace
+from spec_to_tex.manifest import load_manifest, page_hash, save_manifest
 import os
+import re
+from typing import Callable, Iterable
 
-SYSTEM_MESSAGE = """
-    You have been given a specification document, which can either be a homework assignment, project spec, etc. 
-    This document is provided in the form of images.
-    Your task is to convert the specification to a LaTeX template.
-    The LaTeX template should contain everything from the specification document that could be useful for the user or useful to answering any questions or prompts provided in the document. This includes text, tables, equations, etc.
-    If there are any parts of the document that are meant to be filled in by the user, please leave those parts blank in the LaTeX template and prompt the user to fill them in by providing an explicit prompt.
-"""
-
-def from_openai(images: list[int], verbose: bool = False, retries_limit: int = 3) -> str:
-    """
-    Given a list of encoded images (of a document), return a LaTeX template for the document.
-    """
-    from spec_to_tex.wrappers.openai import Client
-
-    api_key = os.getenv("OPENAI_API_KEY")
-
-    # First, we generate the LaTeX template for the document.
-    # 1. Define a Pydantic model for the LaTeX document.
-    # 2. Generate the LaTeX template with GPT-4V.
-    class TeXDocument(BaseModel):
-        packages_needed: list[str] = Field(... , description="The packages to be used in the LaTeX document. For example, 'amsmath', 'graphicx', etc. List them here, and they will be included in the LaTeX document.")
-        document_body:   str = Field(..., description="The body of the LaTeX document. Assume this is wrapped in the document environment (so there is no need to open or close the environment), and that imports, document class definition, and anything else that would be in the header is in the header.")
-
-        def __str__(self) -> str:
-            return """
-            \\documentclass[11pt,addpoints]{exam}
-            """ + "\n".join(
-            ["\\usepackage{package}".format(package="{" + package + "}") for package in self.packages_needed]
-            ) + """
-            \\begin{document}
-            {body}
-            \\end{document}            
-            """.format(body=self.document_body, document="{document}")
-
-    prompt = r"""
-        Generate the LaTeX template for the specification document provided in the images.
+# Generation tries each model in turn, escalating to the next only when the output fails to parse or check
+DEFAULT_MODELS = ["gpt-4o-mini", "gpt-4o"]
 
-        Make sure your generated LaTeX template will correctly render and compile. In particular, avoid issues with:
-        - Missing packages
-        - Incorrectly formatted LaTeX code
-            - Ampersands (&) in text not being escaped
-               - Not escaping special characters in general
-            - Not closing environments properly
-        
-        Sample LaTeX template:
+# Windowed conversion keeps the pages in memory under this many bytes by default. While a request is made, its
+# pages exist as base64 strings, in the JSON request body, and in the encoding hashed for the cache key.
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+PAYLOAD_COPIES = 3
 
+SAMPLE_TEMPLATE = r"""
         \begin{questions}
         \question \textbf{Short-answer potpourri.}
         
@@ -99,123 +68,462 @@ def from_openai(images: list[int], verbose: bool = False, retries_limit: int = 3
         \pagebreak
 
         \end{questions}
+"""
+
+# Everything static (the instructions, the sample template, and the response schema; see wrappers.openai.system_prompt)
+# goes in the system message, so all requests share a prefix that the API can cache; only the prompt and pages vary.
+SYSTEM_MESSAGE = """
+    You have been given a specification document, which can either be a homework assignment, project spec, etc. 
+    This document is provided in the form of page images, and/or the text extracted from pages whose text layer is reliable.
+    Your task is to convert the specification to a LaTeX template.
+    The LaTeX template should contain everything from the specification document that could be useful for the user or useful to answering any questions or prompts provided in the document. This includes text, tables, equations, etc.
+    If there are any parts of the document that are meant to be filled in by the user, please leave those parts blank in the LaTeX template and prompt the user to fill them in by providing an explicit prompt.
 
-        Generated LaTeX template:
+    Sample LaTeX template:
+""" + SAMPLE_TEMPLATE
+
+class TeXDocument(BaseModel):
+    packages_needed: list[str] = Field(... , description="The packages to be used in the LaTeX document. For example, 'amsmath', 'graphicx', etc. List them here, and they will be included in the LaTeX document.")
+    document_body:   str = Field(..., description="The body of the LaTeX document. Assume this is wrapped in the document environment (so there is no need to open or close the environment), and that imports, document class definition, and anything else that would be in the header is in the header.")
+
+    def __str__(self) -> str:
+        return """
+        \\documentclass[11pt,addpoints]{exam}
+        """ + "\n".join(
+        ["\\usepackage{package}".format(package="{" + package + "}") for package in self.packages_needed]
+        ) + """
+        \\begin{document}
+        {body}
+        \\end{document}            
+        """.format(body=self.document_body, document="{document}")
+
+GENERATION_PROMPT = r"""
+        Generate the LaTeX template for the specification document provided in the page images and extracted page text, in the style of the sample LaTeX template.
+
+        Make sure your generated LaTeX template will correctly render and compile. In particular, avoid issues with:
+        - Missing packages
+        - Incorrectly formatted LaTeX code
+            - Ampersands (&) in text not being escaped
+               - Not escaping special characters in general
+            - Not closing environments properly
     """
 
-    if verbose:
-        print("Generating the LaTeX template for the document...")
+FIX_PROMPT = """
+    Checking the LaTeX document below found errors. Only the lines around the errors are shown, each prefixed with its line number.
 
-    generator = Client(api_key, schema=TeXDocument, system_message=SYSTEM_MESSAGE)
-    response: dict = generator.get_response(prompt, system_message=SYSTEM_MESSAGE, images=images)
-    print(response)
-    document: TeXDocument = TeXDocument(**response)
+    Fix the errors by replacing ranges of lines. Only change what is needed to fix the errors; lines you don't replace are kept as they are.
 
-    if verbose:
-        print("Generated the LaTeX template for the document.")
-        print(document)
+    Errors:
 
-    # Next, we analyze the LaTeX document to ensure it will render and compile correctly.
-    # 1. Define a Pydantic model for the LaTeX document. We will structure the model to help the model develop a chain of thought, but will only use the document_body field.
-    # 2. Generate the analysis of the LaTeX document with GPT-4V.
-    # 3. If the document will not render and compile correctly, generate a fix for the document with GPT-4V.
+    {errors}
 
-    if verbose: 
-        print("Analyzing the LaTeX document...")
+    Lines of the document ({lines} lines in total):
 
-    class Analysis(BaseModel):
-        analysis: str = Field(default="There seem to be no problems. The provided LaTeX document will render and compile correctly.", description="The analysis of errors with the LaTeX document.")
-        will_render: bool = Field(default=True, description="Whether the LaTeX document will render and compile correctly.")
+    {excerpts}
+"""
 
-        def __str__(self) -> str:
-            return self.analysis
+FIX_CONTEXT = 3  # lines sent on each side of a line with an error
 
-    analyzer = Client(api_key, schema=Analysis, system_message=SYSTEM_MESSAGE)
+# line numbers in error messages: "line 12: ..." and "... on line 3" (utils.validate), "l.12 ..." (TeX logs)
+ERROR_LINE = re.compile(r"\bline (\d+)|\bl\.(\d+)")
 
-    prompt = f"""
-        Analyze the provided LaTeX document. Will it correctly render and compile? 
-        In particular, ensure that:
-        - All special characters are escaped
-        - All environments are closed properly
-            - Tags are not double-closed or opened
-        - All packages needed are included
-        - Non-existent packages are not included
+class Edit(BaseModel):
+    first_line: int = Field(..., description="The number of the first line to replace.")
+    last_line: int = Field(..., description="The number of the last line to replace; the same as first_line to replace a single line.")
+    replacement: str = Field(..., description="The new text for those lines, without line numbers; several lines are separated by newlines. Empty to delete the lines.")
 
-        Document:
+class TeXFix(BaseModel):
+    edits: list[Edit] = Field(..., description="The replacements that fix the errors. Line numbers refer to the document as shown, and ranges must not overlap.")
 
-        {document}
+def _excerpts(tex: str, errors: list[str]) -> str:
+    """
+    Return the numbered lines of tex around the lines named in errors, with "..." marking lines left out.
+    The whole document is returned if an error names no line.
+    """
+    lines = tex.split("\n")
+    wanted = set()
+    for error in errors:
+        numbers = [int(match.group(1) or match.group(2)) for match in ERROR_LINE.finditer(error)]
+        if not numbers:
+            wanted = set(range(1, len(lines) + 1))
+            break
+        for number in numbers:
+            wanted.update(range(max(1, number - FIX_CONTEXT), min(len(lines), number + FIX_CONTEXT) + 1))
+
+    excerpts, previous = [], 0
+    for number in sorted(wanted):
+        if number > previous + 1:
+            excerpts.append("...")
+        excerpts.append(f"{number}: {lines[number - 1]}")
+        previous = number
+    if previous < len(lines):
+        excerpts.append("...")
+    return "\n".join(excerpts)
+
+def _apply_edits(tex: str, edits: list[Edit]) -> str:
+    """
+    Replace the line ranges of tex given by edits. Edits out of range, or overlapping an earlier edit, are ignored.
     """
+    lines = tex.split("\n")
+    result, done = [], 0  # lines[:done] have been copied or replaced
+    for edit in sorted(edits, key=lambda edit: (edit.first_line, edit.last_line)):
+        if not done < edit.first_line <= edit.last_line <= len(lines):
+            continue
+        result.extend(lines[done:edit.first_line - 1])
+        if edit.replacement:
+            result.extend(edit.replacement.split("\n"))
+        done = edit.last_line
+    result.extend(lines[done:])
+    return "\n".join(result)
+
+def merge_documents(documents: list[TeXDocument]) -> TeXDocument:
+    """
+    Merge documents generated for consecutive page chunks into one document.
 
-    response: dict = analyzer.get_response(prompt, system_message=SYSTEM_MESSAGE)
-    analysis: Analysis = Analysis(**response)
+    Packages are deduplicated in order of first appearance and bodies are concatenated in page order.
+    """
+    packages_needed = list(dict.fromkeys(package for document in documents for package in document.packages_needed))
+    document_body = "\n\n".join(document.document_body.strip() for document in documents if document.document_body.strip())
+    return TeXDocument(packages_needed=packages_needed, document_body=document_body)
+
+def _chunk_prompt(first: int, last: int, total: int) -> str:
+    return GENERATION_PROMPT + f"""
+        Note: the provided pages are only pages {first} to {last} of a {total}-page document. 
+        The other pages are converted separately and the results are concatenated in page order, so only convert the provided pages.
+        Keep your output self-contained: close any environment you open, even if it continues on a later page.
+    """
 
-    # If the document will not render and compile correctly, generate a fix for the document.
-    num_retries = 0
-    while not analysis.will_render:
+def _generate_once(generator, images: list, prompt: str, stream: Callable[[str], None] | None = None) -> TeXDocument:
+    if stream:
+        # surface the document body as it arrives, before the rest of the JSON is complete
+        body = JSONStringStream("document_body")
 
-        if verbose:
-            print("The provided LaTeX document will not render and compile correctly.")
-            print("The analysis of the document is as follows:")
-            print(analysis)
-            print()
-            print("Generating a fix for the document...")
+        def on_delta(delta: str) -> None:
+            text = body.feed(delta)
+            if text:
+                stream(text)
+
+        response: dict = generator.stream_response(prompt, on_delta, images=images)
+    else:
+        response: dict = generator.get_response(prompt, images=images)
+    return TeXDocument(**response)
+
+def _generate(generators: list, images: list, prompt: str = GENERATION_PROMPT, stream: Callable[[str], None] | None = None,
+              check: Callable[[TeXDocument], list[str]] | None = None) -> TeXDocument:
+    """
+    Generate a document with the first of generators (cheapest first) whose output parses and passes check.
+
+    The last generator's output is returned as is; the caller checks and fixes it. Only the first attempt is
+    streamed, since later attempts replace it.
+    """
+    for tier, generator in enumerate(generators):
+        last = tier == len(generators) - 1
+        with trace.span("generate.attempt", model=generator.model, tier=tier) as attributes:
+            try:
+                document = _generate_once(generator, images, prompt, stream if tier == 0 else None)
+            except (ValueError, TypeError, KeyError) as e:
+                # the completion wasn't JSON, or didn't match the schema; API errors (APIError) are raised as is
+                if last:
+                    raise
+                attributes["escalated"] = f"unparseable output: {type(e).__name__}"
+                continue
+            if last or check is None:
+                return document
+            errors = check(document)
+            if not errors:
+                return document
+            attributes["escalated"] = f"{len(errors)} errors"
+
+def _generate_chunks(generators: list, images: list, chunks: list[tuple[int, list]], workers: int,
+                     stream: Callable[[str], None] | None = None,
+                     check: Callable[[TeXDocument], list[str]] | None = None) -> list[TeXDocument]:
+    """
+    Generate a fragment for each (index of first page, pages) chunk of the document, concurrently, in chunk order.
+
+    If stream is set, it is called with the body of each fragment as soon as it and all earlier fragments are done.
+    Each chunk escalates through generators independently (see _generate).
+    """
+    def generate_chunk(chunk: tuple[int, list]) -> TeXDocument:
+        first, pages = chunk
+        with trace.span("generate.chunk", first_page=first + 1, pages=len(pages)):
+            return _generate(generators, pages, _chunk_prompt(first + 1, first + len(pages), len(images)), check=check)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    fragments = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # map yields results in submission order, so the merge is deterministic
+        for fragment in pool.map(trace.bind(generate_chunk), chunks):
+            if stream:
+                stream(fragment.document_body.strip() + "\n\n")
+            fragments.append(fragment)
+    return fragments
+
+def _page_bytes(page) -> int:
+    if page is None:
+        return 0
+    if isinstance(page, dict):
+        return len(page["text"])
+    if isinstance(page, list):
+        return sum(len(tile) for tile in page)
+    return len(page)
+
+def _generate_windows(generators: list, pages: Iterable, total: int, window: int, max_memory: int, workers: int,
+                      stream: Callable[[str], None] | None = None,
+                      check: Callable[[TeXDocument], list[str]] | None = None) -> list[TeXDocument]:
+    """
+    Generate a fragment for each window of up to `window` consecutive pages, in page order, taking pages from the
+    iterable (e.g. a rasterize.PageStream) only as they are needed, so memory use doesn't grow with the document.
+
+    Up to `workers` windows are generated concurrently while the next is rasterized. The pages held in memory,
+    counting the copies made for each request, are kept under max_memory bytes: a window is cut short when it
+    would take more than its share, and no page is taken until enough earlier windows have finished.
+    If stream is set, it is called with the body of each fragment as soon as it and all earlier fragments are done.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    budget = max(1, max_memory // PAYLOAD_COPIES)
+    fragments = []
+    in_flight = deque()  # (future, bytes of its pages), oldest first
+    held = 0
+
+    def generate_window(first: int, window_pages: list) -> TeXDocument:
+        with trace.span("generate.window", first_page=first + 1, pages=len(window_pages)):
+            return _generate(generators, window_pages, _chunk_prompt(first + 1, first + len(window_pages), total), check=check)
+
+    def collect() -> None:
+        # wait for the oldest window, which releases its pages
+        nonlocal held
+        future, size = in_flight.popleft()
+        fragment = future.result()
+        held -= size
+        if stream:
+            stream(fragment.document_body.strip() + "\n\n")
+        fragments.append(fragment)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        first, current, size = 0, [], 0
+        for page in pages:
+            page_size = _page_bytes(page)
+            if current and (len(current) == window or size + page_size > budget // workers):
+                while len(in_flight) >= workers:
+                    collect()
+                in_flight.append((pool.submit(trace.bind(generate_window), first, current), size))
+                held += size
+                first, current, size = first + len(current), [], 0
+            while in_flight and held + size + page_size > budget:
+                collect()
+            current.append(page)
+            size += page_size
+        if current:
+            in_flight.append((pool.submit(trace.bind(generate_window), first, current), size))
+        while in_flight:
+            collect()
+    return fragments
+
+def from_openai(images: list[int], verbose: bool = False, retries_limit: int = 3, chunk_size: int | None = None, workers: int = 4,
+                compile_check: bool = False, engine: str | None = None, manifest: str | None = None,
+                stream: Callable[[str], None] | None = None, models: list[str] | None = None, fix_model: str | None = None,
+                page_index=None, window: int | None = None, max_memory: int | None = None) -> str:
+    """
+    Given a list of encoded images or text-layer pages (of a document), return a LaTeX template for the document.
 
-        class Fix(BaseModel):
-            fix: str = Field(description="The corrected LaTeX document, which will compile and render correctly.")
+    If chunk_size is set, the document is split into chunks of that many pages, which are converted
+    concurrently by up to `workers` threads and then merged in page order.
 
-        fixer = Client(api_key, schema=Fix, system_message=SYSTEM_MESSAGE)
+    If window is set, images may be any sized iterable, such as a rasterize.PageStream. The document is converted
+    in windows of up to that many pages, taking pages from images only as they are submitted, so that no more
+    than max_memory bytes (default DEFAULT_MAX_MEMORY) of pages are held at once (see _generate_windows).
 
-        prompt = f"""
-            Given the below LaTeX document and an analysis of some issues with the document, provide a fix for the document.
+    If manifest is set (a path, see spec_to_tex.manifest), each page is converted separately and only pages
+    whose hash is not in the manifest from a previous run are sent to the model; the manifest is then updated.
 
-            Ensure that your fix will allow the document to render and compile correctly.
+    If page_index is set (a spec_to_tex.pageindex.PageIndex), each page is also converted separately, pages
+    matching a page converted for any earlier document reuse its fragment, and the fragments of newly
+    converted pages that pass the checks are added to the index.
 
-            Document:
+    If stream is set, it is called with each new piece of the generated document body as it arrives, so callers
+    can show output before generation is complete. The returned document (after checks and fixes) is final.
 
-            {document}
+    Generation is tiered: each document (or chunk, or page) is generated with the first of `models` (default
+    DEFAULT_MODELS, cheapest first), and regenerated with the next model only if the output fails to parse or
+    check. Fixes use fix_model, by default the first of models: fixes only see a few lines, and a stronger model
+    can be asked for with fix_model.
 
-            Analysis:
+    The result is checked locally (see utils.validate), and compiled with `engine` if compile_check is set;
+    only when errors are found is the model asked for a fix, given the errors and the lines around them, which it
+    answers with line replacements.
+    """
+    from spec_to_tex.wrappers.openai import Client
 
-            {analysis}
+    api_key = os.getenv("OPENAI_API_KEY")
+
+    # First, we generate the LaTeX template for the document.
+    if verbose:
+        print("Generating the LaTeX template for the document...")
 
-            Fixed Document:
-        """
-        response: dict = fixer.get_response(prompt, system_message=SYSTEM_MESSAGE)
-        fix: Fix = Fix(**response)
+    models = models or DEFAULT_MODELS
+    generators = [Client(api_key, schema=TeXDocument, system_message=SYSTEM_MESSAGE, model=model) for model in models]
+
+    checked = {}  # a document that passed the check during generation isn't checked (or compiled) again
+
+    def check_tex(tex: str) -> list[str]:
+        if tex in checked:
+            return checked[tex]
+        with trace.span("validate", compile=compile_check) as attributes:
+            errors = checked[tex] = validate(tex, compile_check=compile_check, engine=engine)
+            attributes["errors"] = len(errors)
+            return errors
+
+    def check(document: TeXDocument) -> list[str]:
+        return check_tex(clean_doc(str(document).strip()))
+
+    with trace.span("generate", pages=len(images)):
+        if manifest or page_index is not None:
+            # Per-page mode: one fragment per page, reusing the fragments of pages that haven't changed since
+            # the last run (manifest) or that match a page of another document (page_index).
+            # pages dropped as blank by preprocessing (None) get an empty fragment, without a request
+            hashes = [page_hash(image) for image in images]
+            previous = load_manifest(manifest) if manifest else {}
+            reused = {i: TeXDocument(packages_needed=[], document_body="") for i, image in enumerate(images) if image is None}
+            reused.update({i: TeXDocument(**previous[h]) for i, h in enumerate(hashes) if h in previous and i not in reused})
+            fingerprints = {}
+            if page_index is not None:
+                from spec_to_tex.pageindex import fingerprint
+
+                unchanged = len(reused)
+                with trace.span("page index", pages=len(images) - unchanged) as attributes:
+                    for i, image in enumerate(images):
+                        key = None if i in reused else fingerprint(image)
+                        if key is None:
+                            continue
+                        fingerprints[i] = key
+                        fragment = page_index.lookup(key)
+                        if fragment is not None:
+                            reused[i] = TeXDocument(**fragment)
+                    attributes["matched"] = len(reused) - unchanged
+            changed = [i for i in range(len(images)) if i not in reused]
+            if verbose:
+                print(f"{len(images) - len(changed)} of {len(images)} pages are unchanged or shared with another document; "
+                      f"converting {len(changed)} pages...")
+
+            generated = dict(zip(changed, _generate_chunks(generators, images, [(i, [images[i]]) for i in changed], workers, check=check)))
+            fragments = [generated[i] if i in generated else reused[i] for i in range(len(images))]
+            if manifest:
+                kept = [i for i, image in enumerate(images) if image is not None]
+                save_manifest(manifest, [hashes[i] for i in kept], [fragments[i].model_dump() for i in kept])
+            if page_index is not None:
+                for i, fragment in generated.items():
+                    if i in fingerprints and not check(fragment):
+                        page_index.add(fingerprints[i], fragment.model_dump())
+                page_index.save()
+            document: TeXDocument = merge_documents(fragments)
+            if stream:
+                stream(document.document_body)
+        elif window:
+            if verbose:
+                print(f"Converting {len(images)} pages in windows of up to {window} pages...")
+            pages = (image for image in images if image is not None)  # blank pages are dropped, not sent
+            document: TeXDocument = merge_documents(_generate_windows(generators, pages, len(images), window,
+                                                                      max_memory or DEFAULT_MAX_MEMORY, workers, stream, check))
+        else:
+            pages = [image for image in images if image is not None]  # blank pages are dropped, not sent
+            if not pages:
+                document = TeXDocument(packages_needed=[], document_body="")
+            elif chunk_size and len(pages) > chunk_size:
+                chunks = [(first, pages[first:first + chunk_size]) for first in range(0, len(pages), chunk_size)]
+                if verbose:
+                    print(f"Converting {len(pages)} pages in {len(chunks)} chunks of up to {chunk_size} pages...")
+                document: TeXDocument = merge_documents(_generate_chunks(generators, pages, chunks, workers, stream, check))
+            else:
+                document: TeXDocument = _generate(generators, pages, stream=stream, check=check)
+
+    if verbose:
+        print("Generated the LaTeX template for the document.")
+        print(document)
+
+    # Next, we check locally that the LaTeX document will render and compile correctly.
+    # 1. Run a structural check (balanced braces/environments/math, escaped specials, installed packages),
+    #    and, if compile_check is set, compile the document in a sandbox.
+    # 2. If there are errors, ask for a fix, sending only the errors and the lines around them, and apply the
+    #    line replacements that come back.
+    # 3. Re-check the fixed document, up to retries_limit times.
+
+    if verbose: 
+        print("Checking the LaTeX document...")
+
+    with trace.span("clean"):
+        tex = clean_doc(document.__str__().strip())
+    errors = check_tex(tex)
+    fixer = Client(api_key, schema=TeXFix, system_message=SYSTEM_MESSAGE, model=fix_model or models[0])
+
+    num_retries = 0
+    while errors and num_retries < retries_limit:
 
-        document.document_body = fix.fix
+        if verbose:
+            print("The provided LaTeX document will not render and compile correctly.")
+            print("The errors found in the document are as follows:")
+            print("\n".join(errors))
+            print()
+            print("Generating a fix for the document...")
+
+        with trace.span("fix", attempt=num_retries + 1, errors=len(errors)) as attributes:
+            excerpts = _excerpts(tex, errors)
+            attributes["excerpt_lines"] = excerpts.count("\n") + 1
+            prompt = FIX_PROMPT.format(errors="\n".join(errors), lines=tex.count("\n") + 1, excerpts=excerpts)
+            fix = TeXFix(**fixer.get_response(prompt))
+            attributes["edits"] = len(fix.edits)
+            tex = clean_doc(_apply_edits(tex, fix.edits))
         if verbose:
             print("Generated a fix.")
         num_retries += 1
 
-        if num_retries >= retries_limit:
-            if verbose:
-                print("Reached the maximum number of retries. Breaking...")
-            break
-        else:
-            # re-analyze the document to ensure it will render and compile correctly.
-            if verbose:
-                print("Re-analyzing the document...")
-            response: dict = analyzer.get_response(prompt, system_message=SYSTEM_MESSAGE)
-            analysis: Analysis = Analysis(**response)
+        # re-check the fixed document
+        errors = check_tex(tex)
 
-    if num_retries < retries_limit:
+    if not errors:
         print("TeX creation successful.")
     else:
+        if verbose:
+            print("Reached the maximum number of retries.")
         print("TeX has been created. However, there may be issues with the document.")
 
-    return clean_doc(document.__str__().strip())
+    return tex
 
-def from_llama(path: str) -> str:
-    from spec_to_tex.wrappers.llamaparse import get_response
+def from_structure(pages: list[list[dict]], verbose: bool = False) -> str:
+    """
+    Given the lines extracted from a document (see spec_to_tex.structure.extract_pages), return a LaTeX template
+    for the document, built locally with layout heuristics and no API calls.
+    """
+    from spec_to_tex.structure import to_tex
+
+    packages_needed, document_body = to_tex(pages)
+    document = TeXDocument(packages_needed=packages_needed, document_body=document_body)
+    tex = clean_doc(document.__str__().strip())
 
-    prompt = """
-        Recreate the provided document, but in LaTeX.
+    errors = validate(tex)
+    if verbose and errors:
+        print("The generated LaTeX document may not compile:")
+        print("\n".join(errors))
+    return tex
 
-        If there are any parts of the document that are meant to be filled in by the user, please leave those parts blank in the LaTeX template and prompt the user to fill them in by providing an explicit prompt.
+LLAMA_INSTRUCTION = """
+    Recreate the provided document, but in LaTeX.
+
+    If there are any parts of the document that are meant to be filled in by the user, please leave those parts blank in the LaTeX template and prompt the user to fill them in by providing an explicit prompt.
+"""
+
+def from_llama(path: str, verbose: bool = False) -> str:
+    """
+    Given the path to a PDF, return a LaTeX template for the document, parsed page by page with LlamaParse.
     """
+    from spec_to_tex.wrappers.llamaparse import get_response
 
-    response: str = get_response(prompt, path)
-    print(response)
+    tex = clean_doc(get_response(LLAMA_INSTRUCTION, path))
 
-    return response
\ No newline at end of file
+    errors = validate(tex)
+    if verbose and errors:
+        print("The generated LaTeX document may not compile:")
+        print("\n".join(errors))
+    return tex
@@ -0,0 +1,47 @@
+"""
+Manifests for incremental re-conversion.
+
+A manifest sits next to an output .tex file and maps the hash of each page that went into it to the TeX
+fragment generated for that page. When a revised version of the document is converted, pages whose hash is
+already in the manifest reuse their fragment and only the changed pages are sent to the model.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+def manifest_path(output: str) -> str:
+    return os.path.splitext(output)[0] + ".manifest.json"
+
+def page_hash(page: str | dict | list | None) -> str:
+    # pages are base64 images, text-layer content parts (see spec_to_tex.textlayer), or lists of image tiles
+    # (see spec_to_tex.preprocess); blank pages dropped by preprocessing (None) are never recorded in a manifest
+    if not isinstance(page, str):
+        page = json.dumps(page, sort_keys=True)
+    return hashlib.sha256(page.encode("utf-8")).hexdigest()
+
+def load_manifest(path: str) -> dict[str, dict]:
+    """
+    Return a mapping from page hash to fragment ({"packages_needed": [...], "document_body": "..."}).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {page["hash"]: page["fragment"] for page in json.load(f)["pages"]}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+def save_manifest(path: str, hashes: list[str], fragments: list[dict]) -> None:
+    """
+    Atomically write the manifest for a document whose pages have the given hashes, in page order.
+    """
+    manifest = {"pages": [{"hash": h, "fragment": fragment} for h, fragment in zip(hashes, fragments)]}
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,205 @@
+"""
+Cross-document index of page fingerprints.
+
+Specifications from the same course repeat the same cover, honor-code and submission-instructions pages.
+The response cache keys on whole requests and a manifest (see spec_to_tex.manifest) only covers earlier
+versions of the same output, so neither shares the TeX generated for such a page between documents. The
+page index maps a fingerprint of each converted page to the fragment generated for it, so that a matching
+page in any later document reuses the fragment instead of being sent to the model:
+
+- Image pages are found by a 1024-bit difference hash (dHash) of a 33x32 thumbnail of the page: a page
+  re-rendered or re-encoded never hashes the same byte for byte, but its dHash barely changes. Pages whose
+  hashes differ in at most `threshold` bits are candidates.
+- A candidate is only reused once it is confirmed on a finer thumbnail: the page scaled to 256 pixels wide
+  (a few pixels per character) and quantized to 16 grey levels. Every pixel must be within one level of the
+  candidate's. Re-encoding noise stays within that, but a changed word or digit (a different assignment
+  number or due date) shifts the pixels it covers by several levels, so the page is regenerated.
+- Text pages (see spec_to_tex.textlayer) and tiled pages match exactly, on their whitespace-normalized text
+  and contents, since a text page that differs at all has to be regenerated.
+
+To find candidates without comparing against every entry, each hash is split into threshold + 1 bands and
+entries are bucketed by band. Hashes that differ in at most threshold bits agree on at least one band, so only
+entries sharing a bucket are compared. The confirmation thumbnails are kept in the response cache (see
+utils.cache); a candidate whose thumbnail has been evicted is not reused.
+
+The index is kept in one JSON file at the top of the cache directory, which cache eviction leaves alone, holds
+at most `max_entries` pages (evicting the least recently used), and is safe to share between threads. When
+several processes share it, the last to save wins.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+
+from utils import cache
+
+HASH_SIZE = 32            # the dHash compares neighbouring pixels of a (HASH_SIZE + 1) x HASH_SIZE thumbnail
+HASH_BITS = HASH_SIZE * HASH_SIZE
+DEFAULT_THRESHOLD = 16    # bits of the 1024-bit dHash in which candidate matches may differ
+THUMBNAIL_WIDTH = 256     # width of the thumbnail on which candidates are confirmed
+THUMBNAIL_LEVELS = 16     # grey levels of that thumbnail; matching pixels may differ by one level
+MAX_ENTRIES = 5000
+INDEX_VERSION = 2
+
+def index_path() -> str:
+    return os.path.join(cache.CACHE_DIR, "pages.json")
+
+def describe_image(encoded: str) -> tuple[int, bytes]:
+    """
+    Return the dHash of a base64-encoded page image (whether each pixel of a grayscale thumbnail is brighter
+    than its right neighbour) and its confirmation thumbnail, as one byte per pixel.
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+    image.draft("L", (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH))  # let the JPEG decoder downscale; no need for full resolution
+    gray = image.convert("L")
+    thumbnail = gray.resize((THUMBNAIL_WIDTH, max(1, round(gray.height * THUMBNAIL_WIDTH / gray.width))), Image.BOX)
+    pixels = thumbnail.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX).tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        for column in range(row * (HASH_SIZE + 1), row * (HASH_SIZE + 1) + HASH_SIZE):
+            bits = bits << 1 | (pixels[column] > pixels[column + 1])
+    step = 256 // THUMBNAIL_LEVELS
+    return bits, thumbnail.point(lambda value: value // step).tobytes()
+
+def same_page(thumbnail: bytes, other: bytes) -> bool:
+    """
+    Whether two confirmation thumbnails show the same page: the same size, and every pixel within one grey level.
+    """
+    return len(thumbnail) == len(other) and all(-1 <= a - b <= 1 for a, b in zip(thumbnail, other))
+
+def fingerprint(page) -> tuple | None:
+    """
+    Return ("image", dHash, thumbnail) for a base64 image, and ("exact", digest, None) for text or tiled pages.
+    Blank pages dropped by preprocessing (None) have no fingerprint.
+    """
+    if page is None:
+        return None
+    if isinstance(page, str):
+        return ("image", *describe_image(page))
+    if isinstance(page, dict) and page.get("type") == "text":
+        normalized = " ".join(page["text"].split())
+    else:
+        normalized = json.dumps(page, sort_keys=True)
+    return "exact", hashlib.sha256(normalized.encode("utf-8")).hexdigest(), None
+
+def _thumbnail_key(key: str) -> str:
+    return cache.cache_key({"page thumbnail": key})
+
+class PageIndex:
+    def __init__(self, path: str | None = None, threshold: int = DEFAULT_THRESHOLD, max_entries: int = MAX_ENTRIES):
+        self.path = path or index_path()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, dict] = OrderedDict()  # key -> fragment, least recently used first
+        self.buckets: dict[tuple[int, int], set[str]] = defaultdict(set)  # (band, band value) -> image keys
+        self.dirty = False
+        # split the hash into threshold + 1 bands (of at least one bit) for bucketing
+        bands = min(HASH_BITS, threshold + 1)
+        self.bands = [(band * HASH_BITS // bands, (band + 1) * HASH_BITS // bands) for band in range(bands)]
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            entries = index["pages"] if index.get("version") == INDEX_VERSION else []
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return
+        for entry in entries[-self.max_entries:]:
+            self._insert(entry["key"], entry["fragment"])
+
+    def _band_keys(self, value: int) -> list[tuple[int, int]]:
+        return [(band, value >> (HASH_BITS - end) & ((1 << (end - start)) - 1)) for band, (start, end) in enumerate(self.bands)]
+
+    def _insert(self, key: str, fragment: dict) -> None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        elif key.startswith("image:"):
+            for bucket in self._band_keys(int(key[len("image:"):], 16)):
+                self.buckets[bucket].add(key)
+        self.entries[key] = fragment
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str) -> None:
+        del self.entries[key]
+        if key.startswith("image:"):
+            for bucket in self._band_keys(int(key[len("image:"):], 16)):
+                self.buckets[bucket].discard(key)
+                if not self.buckets[bucket]:
+                    del self.buckets[bucket]
+
+    def _candidates(self, value: int) -> list[str]:
+        # image keys whose hash is within threshold bits of value, nearest first
+        distances = {}
+        for bucket in self._band_keys(value):
+            for key in self.buckets.get(bucket, ()):
+                if key not in distances:
+                    distances[key] = (int(key[len("image:"):], 16) ^ value).bit_count()
+        return sorted((key for key, distance in distances.items() if distance <= self.threshold), key=distances.get)
+
+    def lookup(self, fingerprint: tuple) -> dict | None:
+        """
+        Return the fragment of a page in the index that matches a page's fingerprint, or None.
+        """
+        kind, value, thumbnail = fingerprint
+        if kind != "image":
+            return self._use(f"exact:{value}")
+        with self.lock:
+            candidates = self._candidates(value)
+        for key in candidates:
+            # confirm on the finer thumbnail before reusing anything
+            stored = cache.get(_thumbnail_key(key))
+            if stored is not None and same_page(thumbnail, base64.b64decode(stored["thumbnail"])):
+                fragment = self._use(key)
+                if fragment is not None:
+                    return fragment
+        return None
+
+    def _use(self, key: str) -> dict | None:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.dirty = True
+            return self.entries[key]
+
+    def add(self, fingerprint: tuple, fragment: dict) -> None:
+        """
+        Record the fragment generated for the page with the given fingerprint.
+        """
+        kind, value, thumbnail = fingerprint
+        key = f"image:{value:0{HASH_BITS // 4}x}" if kind == "image" else f"exact:{value}"
+        if thumbnail is not None:
+            cache.put(_thumbnail_key(key), {"thumbnail": base64.b64encode(thumbnail).decode("ascii")})
+        with self.lock:
+            self._insert(key, fragment)
+            self.dirty = True
+
+    def save(self) -> None:
+        """
+        Atomically write the index, if it changed since it was loaded or last saved.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            pages = [{"key": key, "fragment": fragment} for key, fragment in self.entries.items()]
+            self.dirty = False
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"version": INDEX_VERSION, "pages": pages}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
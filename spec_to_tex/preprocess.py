@@ -0,0 +1,132 @@
+"""
+Adaptive preprocessing of page images to cut vision token cost.
+
+High-detail images are billed per 512px tile after the API rescales them (to fit in 2048x2048, then to a
+shortest side of at most 768px), so a full-resolution page costs the same as a much smaller one. For each
+page we:
+- drop it if it is blank or nearly blank
+- crop the margins
+- convert it to grayscale
+- downscale it to the smallest tile grid at which text stays legible
+- optionally, split it into tiles covering only the regions with content
+"""
+
+import math
+
+BLANK_INK = 0.002      # pages with less than this fraction of dark pixels are dropped
+INK_THRESHOLD = 200    # grayscale values below this count as ink
+MARGIN = 8             # pixels of whitespace kept around the content when cropping
+MIN_DPI = 100          # effective resolution below which small text stops being legible
+MIN_GAP = 24           # pixels of whitespace that separate content regions when tiling
+MAX_GRID = 4           # 2048 / 512
+
+def estimate_image_tokens(width: float, height: float) -> int:
+    """
+    Estimate the input tokens of a high-detail image of the given size, following OpenAI's published rules.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def jpeg_size(data: bytes) -> tuple[int, int] | None:
+    """
+    Return the (width, height) of a JPEG from its frame header, without decoding the image, or None if data
+    is not a JPEG or ends before the header.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1  # fill byte
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # start of frame: length, precision, height, width
+            return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2  # markers without a segment
+        else:
+            i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+def _ink(gray) -> float:
+    histogram = gray.histogram()
+    return sum(histogram[:INK_THRESHOLD]) / max(1, gray.width * gray.height)
+
+def _crop(gray):
+    mask = gray.point(lambda v: 255 if v < INK_THRESHOLD else 0)
+    box = mask.getbbox()
+    if box is None:
+        return gray
+    left, top, right, bottom = box
+    return gray.crop((max(0, left - MARGIN), max(0, top - MARGIN), min(gray.width, right + MARGIN), min(gray.height, bottom + MARGIN)))
+
+def _downscale(gray, dpi: int):
+    # choose the tile grid with the fewest tokens that still keeps the effective resolution legible
+    width, height = gray.size
+    min_scale = min(1.0, MIN_DPI / dpi)
+    best = None
+    for columns in range(1, MAX_GRID + 1):
+        for rows in range(1, MAX_GRID + 1):
+            scale = min(1.0, 512 * columns / width, 512 * rows / height)
+            if scale < min_scale:
+                continue
+            tokens = estimate_image_tokens(width * scale, height * scale)
+            if best is None or (tokens, -scale) < best:
+                best = (tokens, -scale)
+    scale = -best[1] if best else min_scale
+    if scale >= 1.0:
+        return gray
+    from PIL import Image
+
+    return gray.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+def _regions(gray) -> list:
+    # horizontal bands of content separated by at least MIN_GAP rows of whitespace, merged until roughly square
+    from PIL import Image
+
+    profile = gray.point(lambda v: 255 if v < INK_THRESHOLD else 0).resize((1, gray.height), Image.BOX)
+    inked = [value > 0 for value in profile.getdata()]
+    bands, start, gap = [], None, 0
+    for y, ink in enumerate(inked + [False] * MIN_GAP):
+        if ink:
+            start = y if start is None else start
+            gap = 0
+        elif start is not None:
+            gap += 1
+            if gap >= MIN_GAP:
+                bands.append((start, y - gap + 1))
+                start, gap = None, 0
+
+    regions = []
+    for top, bottom in bands:
+        if regions and bottom - regions[-1][0] <= gray.width:
+            regions[-1] = (regions[-1][0], bottom)
+        else:
+            regions.append((top, bottom))
+    return [_crop(gray.crop((0, max(0, top - MARGIN), gray.width, min(gray.height, bottom + MARGIN)))) for top, bottom in regions]
+
+def preprocess(image, dpi: int, tile: bool = False) -> tuple[list, int, int]:
+    """
+    Preprocess a page image. Returns (images, estimated tokens before, estimated tokens after);
+    images is empty for a blank page, and has several entries when tiling.
+    """
+    before = estimate_image_tokens(*image.size)
+    gray = image.convert("L")
+    if _ink(gray) < BLANK_INK:
+        return [], before, 0
+
+    gray = _crop(gray)
+    images = [_downscale(gray, dpi)]
+    after = estimate_image_tokens(*images[0].size)
+    if tile:
+        # tiling only pays off when the content is sparse, so keep whichever is cheaper
+        tiles = [_downscale(region, dpi) for region in _regions(gray)]
+        tiles_after = sum(estimate_image_tokens(*t.size) for t in tiles)
+        if len(tiles) > 1 and tiles_after < after:
+            images, after = tiles, tiles_after
+    return images, before, after
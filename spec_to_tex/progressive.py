@@ -0,0 +1,46 @@
+"""
+Progressive output of a document while it is still being generated.
+
+The partial document body is appended to a file next to the output (`<name>.partial.tex`), or to stdout for
+"-", and flushed as it streams in, so users can watch the TeX appear. The partial file is removed when the
+writer is closed, whether conversion succeeded or failed; the caller then writes the final document (after
+checks and fixes) to the output. The previous output is left alone until then, so a failed conversion never
+leaves a truncated document behind with a fresh modification time.
+"""
+
+import os
+import sys
+
+PARTIAL_HEADER = "% Partial output: generation is still in progress.\n\\documentclass[11pt,addpoints]{exam}\n\\begin{document}\n"
+
+def partial_path(output: str) -> str:
+    return os.path.splitext(output)[0] + ".partial.tex"
+
+class ProgressiveWriter:
+    def __init__(self, output: str):
+        self.output = output
+        self.file = sys.stdout if output == "-" else open(partial_path(output), "w")
+        self.file.write(PARTIAL_HEADER)
+        self.file.flush()
+
+    def write(self, text: str) -> None:
+        self.file.write(text)
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is sys.stdout:
+            # the final document follows on stdout
+            self.file.write("\n\\end{document}\n% Final document:\n")
+            self.file.flush()
+        else:
+            self.file.close()
+            try:
+                os.remove(self.file.name)
+            except OSError:
+                pass
+
+    def __enter__(self) -> "ProgressiveWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,134 @@
+"""
+Rasterization of specification documents into page images.
+
+Pages are streamed out of pdf2image a few at a time and encoded straight to JPEG bytes in memory,
+so there is no round-trip through a temporary directory and only a handful of PIL images are alive at once.
+Wrapped in a `PageStream`, the encoded pages are produced only as they are consumed, so windowed conversion
+never holds the whole document in memory.
+"""
+
+import base64
+import io
+from typing import Callable, Iterator
+
+DEFAULT_DPI = 200
+DEFAULT_QUALITY = 85
+BATCH_SIZE = 4  # pages rasterized per pdftoppm invocation
+
+def page_count(path: str) -> int:
+    from pdf2image import pdfinfo_from_path
+
+    return int(pdfinfo_from_path(path)["Pages"])
+
+def parse_page_range(spec: str) -> list[tuple[int, int | None]]:
+    """
+    Parse a page selection such as "1-3,7,10-" into (first, last) ranges of 1-based page numbers, where a last
+    of None means the end of the document. Raises ValueError for a malformed selection.
+    """
+    ranges = []
+    for part in spec.split(","):
+        if not part.strip():
+            raise ValueError(f"empty page range in {spec!r}")
+        first, dash, last = (field.strip() for field in part.partition("-"))
+        try:
+            first = int(first) if first else 1
+            last = (int(last) if last else None) if dash else first
+        except ValueError:
+            raise ValueError(f"invalid page range {part.strip()!r}") from None
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(f"invalid page range {part.strip()!r}")
+        ranges.append((first, last))
+    return ranges
+
+def select_pages(ranges: list[tuple[int, int | None]], count: int) -> list[int]:
+    """
+    Return the sorted page numbers selected by ranges (see parse_page_range) in a document of count pages.
+    """
+    pages = set()
+    for first, last in ranges:
+        pages.update(range(first, min(count, last or count) + 1))
+    if not pages:
+        raise ValueError(f"no pages selected; the document has {count} pages")
+    return sorted(pages)
+
+class PageStream:
+    """
+    The pages of a document, produced in page order each time it is iterated, with their number known up front.
+
+    Windowed conversion (see conversion.from_openai) pulls pages from the stream as it submits them, so only
+    the pages being converted are in memory, however long the document.
+    """
+    def __init__(self, count: int, pages: Callable[[], Iterator]):
+        self.count = count
+        self.pages = pages
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator:
+        return self.pages()
+
+def _runs(pages: list[int], batch_size: int) -> Iterator[tuple[int, int]]:
+    # split sorted page numbers into runs of consecutive pages, at most batch_size long
+    start = 0
+    for i in range(1, len(pages) + 1):
+        if i == len(pages) or pages[i] != pages[i - 1] + 1 or i - start == batch_size:
+            yield pages[start], pages[i - 1]
+            start = i
+
+def iter_images(path: str, dpi: int = DEFAULT_DPI, batch_size: int = BATCH_SIZE, pages: list[int] | None = None) -> Iterator:
+    """
+    Yield the pages of the PDF at path as PIL images, in page order.
+
+    If pages is given, only those (1-based) page numbers are rasterized.
+    """
+    from pdf2image import convert_from_path
+
+    pages = sorted(pages) if pages is not None else list(range(1, page_count(path) + 1))
+    for first, last in _runs(pages, batch_size):
+        for image in convert_from_path(path, dpi=dpi, first_page=first, last_page=last):
+            yield image
+
+def encode_image(image, quality: int = DEFAULT_QUALITY) -> str:
+    """
+    Encode a PIL image as a base64 JPEG string.
+    """
+    buffer = io.BytesIO()
+    image = image if image.mode in ("L", "RGB") else image.convert("RGB")
+    image.save(buffer, "JPEG", quality=quality, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+def iter_encoded_pages(path: str, dpi: int = DEFAULT_DPI, quality: int = DEFAULT_QUALITY, pages: list[int] | None = None,
+                       preprocess: bool = False, tile: bool = False, stats: dict | None = None) -> Iterator[str | list[str] | None]:
+    """
+    Yield the pages of the PDF at path as base64 JPEG strings, in page order.
+
+    With preprocess set, each page goes through spec_to_tex.preprocess first: blank pages are yielded as None,
+    and with tile set a page may be yielded as a list of images of its content regions.
+    Estimated image tokens before and after preprocessing are added up in stats, if given.
+    """
+    from spec_to_tex.preprocess import preprocess as prepare
+
+    for image in iter_images(path, dpi=dpi, pages=pages):
+        if not preprocess:
+            yield encode_image(image, quality=quality)
+            image.close()
+            continue
+
+        images, before, after = prepare(image, dpi, tile=tile)
+        image.close()
+        if stats is not None:
+            stats["tokens_before"] = stats.get("tokens_before", 0) + before
+            stats["tokens_after"] = stats.get("tokens_after", 0) + after
+            stats["blank_pages"] = stats.get("blank_pages", 0) + (not images)
+        encoded = [encode_image(i, quality=quality) for i in images]
+        yield None if not encoded else encoded[0] if len(encoded) == 1 else encoded
+
+def stream_encoded_pages(path: str, dpi: int = DEFAULT_DPI, quality: int = DEFAULT_QUALITY, pages: list[int] | None = None,
+                         preprocess: bool = False, tile: bool = False, stats: dict | None = None) -> PageStream:
+    """
+    Like iter_encoded_pages, but return the pages as a PageStream, which rasterizes them as they are consumed.
+    """
+    pages = pages if pages is not None else list(range(1, page_count(path) + 1))
+    return PageStream(len(pages), lambda: iter_encoded_pages(path, dpi=dpi, quality=quality, pages=pages,
+                                                             preprocess=preprocess, tile=tile, stats=stats))
@@ -0,0 +1,234 @@
+"""
+Persistent conversion service.
+
+A long-running local HTTP server (over TCP or a Unix socket) that accepts PDF uploads into a bounded job queue
+and converts them on a pool of worker threads. Imports, the pooled HTTP session to the API and the worker
+threads stay warm between jobs, so clients don't pay per-invocation startup costs.
+
+    POST /jobs                 upload a PDF (the request body); returns 202 {"id": ..., "status": "queued"},
+                               or 503 when the queue is full
+    GET  /jobs/<id>            the job's status: queued, running, done or failed (with timings or the error)
+    GET  /jobs/<id>/result     the generated TeX once the job is done (409 before); add ?wait=1 to block until then
+    GET  /jobs/<id>/stream     the TeX as it is generated, streamed as plain text until the job finishes
+    GET  /health               queue length and worker count
+
+    python -m spec_to_tex --serve 127.0.0.1:8000
+    curl --data-binary @hw.pdf http://127.0.0.1:8000/jobs
+"""
+
+import json
+import os
+import queue
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+MAX_FINISHED_JOBS = 1000  # finished jobs kept around for clients to fetch, oldest dropped first
+
+class Job:
+    def __init__(self, folder: str):
+        self.id = uuid.uuid4().hex
+        self.path = os.path.join(folder, self.id + ".pdf")
+        self.status = "queued"
+        self.error = None
+        self.result = None
+        self.partial = []          # pieces of the TeX body streamed so far
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.changed = threading.Condition()
+
+    def update(self, **fields) -> None:
+        with self.changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.changed.notify_all()
+
+    def stream(self, text: str) -> None:
+        with self.changed:
+            self.partial.append(text)
+            self.changed.notify_all()
+
+    def describe(self) -> dict:
+        description = {"id": self.id, "status": self.status}
+        if self.started:
+            description["queued_seconds"] = round(self.started - self.submitted, 3)
+        if self.finished:
+            description["run_seconds"] = round(self.finished - self.started, 3)
+        if self.error:
+            description["error"] = self.error
+        return description
+
+class ConversionService:
+    """
+    The job queue and worker pool. `rasterize` maps a PDF path to pages; `convert(pages, output, stream)` returns the TeX.
+    """
+    def __init__(self, rasterize: Callable[[str], list], convert: Callable, workers: int = 4, queue_size: int = 64):
+        self.rasterize = rasterize
+        self.convert = convert
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.folder = tempfile.mkdtemp(prefix="spec-to-tex-service-")
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, data: bytes) -> Job | None:
+        """
+        Queue a PDF for conversion. Returns None if the queue is full.
+        """
+        job = Job(self.folder)
+        with open(job.path, "wb") as f:
+            f.write(data)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            os.remove(job.path)
+            return None
+        with self.lock:
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _work(self) -> None:
+        while True:
+            job = self.queue.get()
+            job.update(status="running", started=time.time())
+            try:
+                pages = self.rasterize(job.path)
+                output = os.path.splitext(job.path)[0] + ".tex"
+                job.update(status="done", result=self.convert(pages, output, job.stream), finished=time.time())
+            except Exception as e:
+                job.update(status="failed", error=f"{type(e).__name__}: {e}", finished=time.time())
+            finally:
+                os.remove(job.path)
+                self._forget_old_jobs()
+
+    def _forget_old_jobs(self) -> None:
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job_id]
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service: ConversionService
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            self._json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if not length or length > MAX_UPLOAD_BYTES:
+            self._json(413 if length else 400, {"error": "expected a PDF of at most %d bytes as the request body" % MAX_UPLOAD_BYTES})
+            return
+        job = self.service.submit(self.rfile.read(length))
+        if job is None:
+            self._json(503, {"error": "the job queue is full, try again later"})
+            return
+        self._json(202, job.describe())
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["health"]:
+            self._json(200, {"queued": self.service.queue.qsize(), "workers": self.service.workers})
+            return
+        job = self.service.get(parts[1]) if len(parts) in (2, 3) and parts[0] == "jobs" else None
+        if job is None:
+            self._json(404, {"error": "no such job"})
+        elif len(parts) == 2:
+            self._json(200, job.describe())
+        elif parts[2] == "result":
+            if parse_qs(url.query).get("wait"):
+                with job.changed:
+                    job.changed.wait_for(lambda: job.finished is not None)
+            if job.status == "done":
+                data = job.result.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-tex; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self._json(409 if job.status != "failed" else 500, job.describe())
+        elif parts[2] == "stream":
+            self._stream(job)
+        else:
+            self._json(404, {"error": "not found"})
+
+    def _stream(self, job: Job) -> None:
+        # the response has no length and ends when the connection closes (HTTP/1.0 style)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        sent = 0
+        while True:
+            with job.changed:
+                job.changed.wait_for(lambda: len(job.partial) > sent or job.finished is not None)
+                pieces, done = job.partial[sent:], job.finished is not None
+            sent += len(pieces)
+            if pieces:
+                self.wfile.write("".join(pieces).encode())
+                self.wfile.flush()
+            if done and sent == len(job.partial):
+                break
+        if job.status == "done":
+            self.wfile.write(b"\n% Final document:\n" + job.result.encode())
+        else:
+            self.wfile.write(f"\n% Conversion failed: {job.error}\n".encode())
+        self.close_connection = True
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # http.server expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+def serve(address: str, rasterize: Callable[[str], list], convert: Callable, workers: int = 4, queue_size: int = 64) -> None:
+    """
+    Serve until interrupted. address is "host:port" or "unix:/path/to/socket".
+    """
+    service = ConversionService(rasterize, convert, workers=workers, queue_size=queue_size)
+    handler = type("Handler", (ServiceHandler,), {"service": service})
+
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = _UnixHTTPServer(path, handler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+        server.daemon_threads = True
+
+    print(f"Serving conversions on {address} with {workers} workers (queue size {queue_size}).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,256 @@
+"""
+Local, CPU-only conversion of a specification to a LaTeX template ("structure" mode).
+
+No network access is needed. The pipeline is:
+1. Extract text spans with their positions and font metadata from the PDF (with PyMuPDF).
+2. Group spans into lines, and lines sharing a baseline into rows; order rows by reading order,
+   handling two-column layouts.
+3. Classify rows with heuristics: headings (large or bold), question and part numbering, tables
+   (runs of rows with the same number of aligned cells) and display math (centered rows dense in math).
+4. Emit the same `exam`-class skeleton (questions/parts/solution) that the OpenAI mode produces.
+
+This is much faster and cheaper than the LLM modes, but only as good as the document's text layer and
+layout; scanned documents and complex layouts are better served by the OpenAI mode.
+"""
+
+import re
+from collections import Counter
+
+MATH_FONTS = ("CMMI", "CMSY", "CMEX", "MSBM", "MSAM", "Math", "Symbol", "STIX")
+ROW_TOLERANCE = 2.0        # points by which the baselines of lines in the same row may differ
+CELL_GAP = 12.0            # horizontal gap (points) that separates table cells within a row
+MIN_TABLE_ROWS = 2
+CENTER_TOLERANCE = 0.08    # fraction of page width by which a display-math row may be off center
+MIN_MATH_FRACTION = 0.3    # fraction of a row's characters that must be math for it to be display math
+
+QUESTION = re.compile(r"^(?:(?:Problem|Question|Exercise|Task|Q)\s*(\d+)[.:)]?|(\d+)[.)])(?:\s+(.*))?$", re.IGNORECASE)
+PART = re.compile(r"^\(([a-z]|[ivx]{1,4})\)\s*(.*)$|^([a-z])[.)]\s+(.*)$")
+POINTS = re.compile(r"[(\[]\s*(\d+)\s*(?:points|point|pts|pt|marks)\s*[)\]]", re.IGNORECASE)
+
+TEXT_ESCAPES = {
+    "\\": r"\textbackslash{}", "&": r"\&", "%": r"\%", "$": r"\$", "#": r"\#", "_": r"\_",
+    "{": r"\{", "}": r"\}", "~": r"\textasciitilde{}", "^": r"\textasciicircum{}",
+}
+SYMBOLS = {
+    "≤": r"\leq", "≥": r"\geq", "≠": r"\neq", "≈": r"\approx", "≡": r"\equiv", "±": r"\pm", "×": r"\times",
+    "÷": r"\div", "·": r"\cdot", "∑": r"\sum", "∏": r"\prod", "∫": r"\int", "√": r"\surd", "∞": r"\infty",
+    "∈": r"\in", "∉": r"\notin", "⊆": r"\subseteq", "⊂": r"\subset", "∪": r"\cup", "∩": r"\cap", "∅": r"\emptyset",
+    "∀": r"\forall", "∃": r"\exists", "¬": r"\neg", "∧": r"\wedge", "∨": r"\vee", "→": r"\to", "←": r"\leftarrow",
+    "⇒": r"\Rightarrow", "⇔": r"\Leftrightarrow", "↔": r"\leftrightarrow", "∂": r"\partial", "∇": r"\nabla",
+    "α": r"\alpha", "β": r"\beta", "γ": r"\gamma", "δ": r"\delta", "ε": r"\epsilon", "θ": r"\theta", "λ": r"\lambda",
+    "μ": r"\mu", "π": r"\pi", "σ": r"\sigma", "τ": r"\tau", "φ": r"\phi", "ω": r"\omega", "Δ": r"\Delta",
+    "Σ": r"\Sigma", "Ω": r"\Omega", "Θ": r"\Theta", "Λ": r"\Lambda", "Π": r"\Pi", "Φ": r"\Phi", "−": "-",
+}
+TEXT_REPLACEMENTS = {"“": "``", "”": "''", "‘": "`", "’": "'", "–": "--", "—": "---", "…": r"\ldots{}", "•": r"\textbullet{}"}
+
+def extract_pages(path: str) -> list[list[dict]]:
+    """
+    Return the lines of each page of the PDF at path, in reading order.
+
+    Each line is a dict with its text, bounding box (x0, y0, x1, y1), font size, and whether it is bold,
+    plus the page width and the fraction of its characters set in a math font.
+    """
+    import pymupdf
+
+    pages = []
+    with pymupdf.open(path) as document:
+        for page in document:
+            width = page.rect.width
+            lines = []
+            for block in page.get_text("dict")["blocks"]:
+                if block["type"] != 0:
+                    continue
+                for line in block["lines"]:
+                    spans = [span for span in line["spans"] if span["text"].strip()]
+                    if not spans:
+                        continue
+                    characters = sum(len(span["text"]) for span in spans)
+                    lines.append({
+                        "text": "".join(span["text"] for span in spans).strip(),
+                        "bbox": line["bbox"],
+                        "size": max(span["size"] for span in spans),
+                        "bold": all(span["flags"] & 16 or "Bold" in span["font"] for span in spans),
+                        "math": sum(len(span["text"]) for span in spans if span["font"].startswith(MATH_FONTS)) / characters,
+                        "width": width,
+                    })
+            pages.append(_reading_order(lines, width))
+    return pages
+
+def _reading_order(lines: list[dict], width: float) -> list[dict]:
+    # two-column layout: a good share of lines sit entirely in each half of the page
+    middle = width / 2
+    left = sum(line["bbox"][2] < middle for line in lines)
+    right = sum(line["bbox"][0] > middle for line in lines)
+    two_columns = min(left, right) > 0.25 * len(lines)
+
+    def key(line: dict) -> tuple:
+        column = 1 if two_columns and line["bbox"][0] > middle else 0
+        return (column, round(line["bbox"][3] / ROW_TOLERANCE), line["bbox"][0])
+
+    return sorted(lines, key=key)
+
+def _rows(lines: list[dict]) -> list[list[dict]]:
+    # lines in reading order whose baselines agree form a row, ordered left to right
+    rows = []
+    for line in lines:
+        if rows and abs(rows[-1][0]["bbox"][3] - line["bbox"][3]) <= ROW_TOLERANCE:
+            rows[-1].append(line)
+        else:
+            rows.append([line])
+    return [sorted(row, key=lambda line: line["bbox"][0]) for row in rows]
+
+def _cells(row: list[dict]) -> list[str]:
+    cells = [row[0]["text"]]
+    for previous, line in zip(row, row[1:]):
+        if line["bbox"][0] - previous["bbox"][2] > CELL_GAP:
+            cells.append(line["text"])
+        else:
+            cells[-1] += " " + line["text"]
+    return cells
+
+def _escape(text: str) -> str:
+    out = []
+    in_math = False  # whether the last token of out is a math run, which a following symbol joins
+    for c in text:
+        if c in SYMBOLS:
+            if in_math:
+                out[-1] = out[-1][:-1] + SYMBOLS[c] + "$"
+            else:
+                out.append(f"${SYMBOLS[c]}$")
+            in_math = True
+            continue
+        if c in TEXT_ESCAPES:
+            out.append(TEXT_ESCAPES[c])
+        elif c in TEXT_REPLACEMENTS:
+            out.append(TEXT_REPLACEMENTS[c])
+        else:
+            out.append(c)
+        in_math = False
+    return "".join(out)
+
+def _math(text: str) -> str:
+    out = []
+    for c in text:
+        if c in SYMBOLS:
+            out.append(SYMBOLS[c] + " ")
+        elif c in "&%#$_{}\\":
+            out.append("\\" + c)
+        else:
+            out.append(c)
+    return "".join(out).strip()
+
+def _is_display_math(row: list[dict]) -> bool:
+    x0, x1 = row[0]["bbox"][0], row[-1]["bbox"][2]
+    width = row[0]["width"]
+    centered = abs((x0 + x1) / 2 - width / 2) < CENTER_TOLERANCE * width and x1 - x0 < 0.7 * width
+    text = "".join(line["text"] for line in row)
+    math = sum(line["math"] * len(line["text"]) for line in row) + sum(c in SYMBOLS for c in text)
+    return centered and math >= MIN_MATH_FRACTION * max(1, len(text.replace(" ", "")))
+
+def _item(command: str, text: str) -> str:
+    # \question or \part, with the point value if the text states one
+    text = text or ""
+    points = POINTS.search(text)
+    if points:
+        text = (text[:points.start()] + text[points.end():]).strip()
+        return f"\\{command}[{points.group(1)}] {_escape(text)}".rstrip()
+    return f"\\{command} {_escape(text)}".rstrip()
+
+def to_tex(pages: list[list[dict]]) -> tuple[list[str], str]:
+    """
+    Convert the extracted lines of a document to a LaTeX body. Returns (packages_needed, document_body).
+    """
+    lines = [line for page in pages for line in page]
+    sizes = Counter()
+    for line in lines:
+        sizes[round(line["size"])] += len(line["text"])
+    body_size = sizes.most_common(1)[0][0] if sizes else 10
+
+    out = []
+    paragraph = []
+    table = []
+    in_questions = in_parts = False
+    uses_math = False
+
+    def flush_paragraph() -> None:
+        if paragraph:
+            out.append(" ".join(paragraph))
+            paragraph.clear()
+
+    def flush_table() -> None:
+        if len(table) >= MIN_TABLE_ROWS:
+            columns = max(len(cells) for cells in table)
+            rows = [" & ".join(_escape(cell) for cell in cells) + " \\\\" for cells in table]
+            out.append("\n".join([f"\\begin{{tabular}}{{{'l' * columns}}}"] + rows + ["\\end{tabular}"]))
+        else:
+            for cells in table:
+                paragraph.append(_escape(" ".join(cells)))
+                flush_paragraph()
+        table.clear()
+
+    def solution() -> None:
+        out.append("\\begin{solution}\n\n\\end{solution}")
+
+    for page in pages:
+        previous_bottom = None
+        for row in _rows(page):
+            cells = _cells(row)
+            text = " ".join(cells)
+            top, bottom = min(line["bbox"][1] for line in row), max(line["bbox"][3] for line in row)
+            # a vertical gap of more than about a line separates paragraphs
+            if previous_bottom is not None and top - previous_bottom > 0.8 * row[0]["size"]:
+                flush_paragraph()
+            previous_bottom = bottom
+
+            if len(cells) > 1 and not QUESTION.match(text) and not PART.match(text):
+                if table and len(cells) != len(table[-1]):
+                    flush_table()
+                flush_paragraph()
+                table.append(cells)
+                continue
+            flush_table()
+
+            question, part = QUESTION.match(text), PART.match(text)
+            if question and not row[0]["size"] > body_size * 1.6:
+                flush_paragraph()
+                if in_parts:
+                    solution()
+                    out.append("\\end{parts}")
+                    in_parts = False
+                elif in_questions:
+                    solution()
+                else:
+                    out.append("\\begin{questions}")
+                    in_questions = True
+                paragraph.append(_item("question", question.group(3)))
+            elif part and in_questions:
+                flush_paragraph()
+                if in_parts:
+                    solution()
+                else:
+                    out.append("\\begin{parts}")
+                    in_parts = True
+                paragraph.append(_item("part", part.group(2) if part.group(2) is not None else part.group(4)))
+            elif _is_display_math(row):
+                flush_paragraph()
+                out.append(f"\\[ {_math(text)} \\]")
+                uses_math = True
+            elif row[0]["size"] > body_size * 1.15 or (all(line["bold"] for line in row) and len(text) < 80):
+                flush_paragraph()
+                out.append(f"\\textbf{{{_escape(text)}}}" if in_questions else f"\\section*{{{_escape(text)}}}")
+            else:
+                paragraph.append(_escape(text))
+                uses_math = uses_math or any(c in SYMBOLS for c in text)
+        flush_table()
+        flush_paragraph()
+
+    if in_parts:
+        solution()
+        out.append("\\end{parts}")
+    elif in_questions:
+        solution()
+    if in_questions:
+        out.append("\\end{questions}")
+
+    packages = ["amsmath", "amssymb"] if uses_math else []
+    return packages, "\n\n".join(out)
@@ -0,0 +1,118 @@
+"""
+Text-layer fast path.
+
+Most specifications are LaTeX-generated PDFs with a clean text layer, which is far cheaper to send to the
+model than a high-detail page image. Before rasterizing, we extract the text layer of every page with
+poppler's pdftotext (installed alongside pdf2image), score it, and send pages whose text is good enough as
+text. Only the remaining pages are rasterized and sent as images.
+
+A page is sent as an image when:
+- it has (almost) no text, e.g. a scanned page
+- its text has a low glyph coverage, i.e. many characters that failed to map to Unicode
+- its text is dense in math symbols, whose layout (sub/superscripts, fractions) the text layer loses
+- it contains embedded images (figures, diagrams)
+"""
+
+import re
+import subprocess
+import unicodedata
+from typing import Iterator
+
+from spec_to_tex.rasterize import DEFAULT_DPI, DEFAULT_QUALITY, PageStream, iter_encoded_pages
+
+MIN_CHARACTERS = 50       # fewer non-space characters than this means the page is likely scanned or a figure
+MIN_GLYPH_COVERAGE = 0.98 # fraction of characters that must have mapped to real Unicode characters
+MAX_MATH_DENSITY = 0.02   # fraction of characters that may be math symbols
+
+def extract_text(path: str) -> list[str]:
+    """
+    Return the text layer of each page of the PDF at path.
+    """
+    result = subprocess.run(["pdftotext", "-layout", "-enc", "UTF-8", path, "-"], capture_output=True, check=True)
+    # pages are separated (and terminated) by form feeds
+    return result.stdout.decode("utf-8", errors="replace").split("\f")[:-1]
+
+def image_counts(path: str) -> dict[int, int]:
+    """
+    Return the number of embedded images on each page of the PDF at path (pages without images are omitted).
+    """
+    result = subprocess.run(["pdfimages", "-list", path], capture_output=True, text=True, check=True)
+    counts = {}
+    # the listing starts with a two-line header; the first column of each row is the page number
+    for line in result.stdout.splitlines()[2:]:
+        fields = line.split()
+        if fields and fields[0].isdigit():
+            page = int(fields[0])
+            counts[page] = counts.get(page, 0) + 1
+    return counts
+
+def _is_math(c: str) -> bool:
+    return unicodedata.category(c) == "Sm" or "\u0370" <= c <= "\u03ff" or "\U0001d400" <= c <= "\U0001d7ff"
+
+def score_page(text: str, images: int = 0) -> tuple[bool, str]:
+    """
+    Decide whether a page's text layer can be sent instead of its image. Returns (use_text, reason).
+    """
+    characters = re.sub(r"\s", "", text)
+    if len(characters) < MIN_CHARACTERS:
+        return False, f"only {len(characters)} characters of text"
+    if images:
+        return False, f"{images} embedded image(s)"
+
+    coverage = sum(c != "\ufffd" and c.isprintable() for c in characters) / len(characters)
+    if coverage < MIN_GLYPH_COVERAGE:
+        return False, f"glyph coverage {coverage:.2f}"
+
+    math_density = sum(_is_math(c) for c in characters) / len(characters)
+    if math_density > MAX_MATH_DENSITY:
+        return False, f"math density {math_density:.3f}"
+
+    return True, f"glyph coverage {coverage:.2f}, math density {math_density:.3f}"
+
+def text_page(text: str) -> dict:
+    """
+    Return a page as a text content part, which `wrappers.openai` sends in place of an image.
+
+    The part doesn't mention the page number, so the same page hashes the same wherever it appears.
+    """
+    return {"type": "text", "text": f"Next page (extracted text layer):\n\n{text.rstrip()}"}
+
+def _classify(path: str, pages: list[int] | None, verbose: bool) -> tuple[list[int], dict[int, dict]]:
+    # the selected page numbers, and the text content part of each page good enough to send as text
+    texts = extract_text(path)
+    counts = image_counts(path)
+
+    numbers = pages if pages is not None else list(range(1, len(texts) + 1))
+    text_parts = {}
+    for number in numbers:
+        use_text, reason = score_page(texts[number - 1], counts.get(number, 0))
+        if verbose:
+            print(f"Page {number}: sending {'text' if use_text else 'image'} ({reason}).")
+        if use_text:
+            text_parts[number] = text_page(texts[number - 1])
+    return numbers, text_parts
+
+def _iter_pages(path: str, numbers: list[int], text_parts: dict[int, dict], **options) -> Iterator:
+    images = iter_encoded_pages(path, pages=[number for number in numbers if number not in text_parts], **options)
+    for number in numbers:
+        yield text_parts[number] if number in text_parts else next(images)
+
+def load_pages(path: str, dpi: int = DEFAULT_DPI, quality: int = DEFAULT_QUALITY, verbose: bool = False,
+               preprocess: bool = False, tile: bool = False, stats: dict | None = None, pages: list[int] | None = None) -> list:
+    """
+    Return the pages of the PDF at path in page order: a text content part for each page with a good text
+    layer, and a base64 JPEG for every other page (see rasterize.iter_encoded_pages for preprocess/tile/stats).
+    If pages is given, only those (1-based) page numbers are returned.
+    """
+    numbers, text_parts = _classify(path, pages, verbose)
+    return list(_iter_pages(path, numbers, text_parts, dpi=dpi, quality=quality, preprocess=preprocess, tile=tile, stats=stats))
+
+def stream_pages(path: str, dpi: int = DEFAULT_DPI, quality: int = DEFAULT_QUALITY, verbose: bool = False,
+                 preprocess: bool = False, tile: bool = False, stats: dict | None = None, pages: list[int] | None = None) -> PageStream:
+    """
+    Like load_pages, but return the pages as a PageStream: the text layer is read up front, and the pages
+    sent as images are rasterized as they are consumed.
+    """
+    numbers, text_parts = _classify(path, pages, verbose)
+    return PageStream(len(numbers), lambda: _iter_pages(path, numbers, text_parts, dpi=dpi, quality=quality,
+                                                        preprocess=preprocess, tile=tile, stats=stats))
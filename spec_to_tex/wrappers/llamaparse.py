@@ -1,44 +1,226 @@
-import nest_asyncio
-nest_asyncio.apply()
-from llama_parse import LlamaParse
-from dotenv import load_dotenv
-import regex as re
-
-load_dotenv()
-
-def remove_duplicate_substrings(text, substring, first=True):
-    # Find all start indices of the substring in the text
-    indices = [m.start() for m in re.finditer(re.escape(substring), text)]
-    if not indices:
-        return text  # Return the original text if the substring is not found
-    
-    # Keep the first occurrence and remove the rest
-    if first:
-        first_index = indices[0]
-        return (text[:first_index + len(substring)] +
-                text[first_index + len(substring):].replace(substring, ""))
-    else: # last
-        last_index = indices[-1]
-        return (text[:last_index].replace(substring, "") +
-                text[last_index:])
+"""
+Asynchronous client for the LlamaParse REST API.
 
+A document is parsed by uploading it (POST /api/parsing/upload), polling the job with backoff until it
+finishes (GET /api/parsing/job/<id>), and fetching its per-page results (GET /api/parsing/job/<id>/result/json).
+`AsyncClient` does this for many documents concurrently over one pooled aiohttp session; LlamaParse parses
+each page separately, so `merge_pages` joins the pages' LaTeX into one document. The blocking `get_response`
+runs every call on one shared client and event loop (on a background thread), so documents converted on
+several threads, as in batch and service mode, are parsed concurrently over the same session.
 
-def get_response(prompt: str, document_path: str) -> str:
-    response = LlamaParse(result_type="markdown", parsing_instruction=prompt).load_data(document_path)
-    response = response[0].text
+Results are cached by the document's contents and the parsing instruction. Set `LLAMA_CLOUD_BASE_URL` to
+point the client at a different endpoint, e.g. the local stub server in benchmarks/stub_server.py.
+"""
+
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import os
+import random
+import threading
+import time
+from utils import cache, trace
+
+BASE_URL = os.getenv("LLAMA_CLOUD_BASE_URL", "https://api.cloud.llamaindex.ai")
+TIMEOUT = 60              # seconds per request
+JOB_TIMEOUT = 900         # seconds to wait for a job to finish
+POLL_INTERVAL = 0.5       # seconds before the first poll; the interval grows by POLL_BACKOFF up to POLL_CAP
+POLL_BACKOFF = 1.5
+POLL_CAP = 10.0
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+FAILED_STATUSES = {"ERROR", "CANCELED", "CANCELLED"}
+
+_shared = None  # (event loop, client) used by get_response
+_shared_lock = threading.Lock()
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _strip_fences(page: str) -> str:
+    # markdown results often wrap the LaTeX in a ```latex code fence
+    page = page.strip()
+    if page.startswith("```"):
+        newline = page.find("\n")
+        page = page[newline + 1:] if newline != -1 else ""
+        if page.rstrip().endswith("```"):
+            page = page.rstrip()[:-3]
+    return page
+
+def merge_pages(pages: list[str]) -> str:
+    """
+    Merge the LaTeX of separately parsed pages into one document, in one pass over the pages.
+
+    Each page may be a complete document; the preamble lines of all pages are kept once each, in order of
+    first appearance (so \\documentclass comes from the first page), and the bodies are concatenated.
+    """
+    preamble, seen, bodies = [], set(), []
+    for page in pages:
+        page = _strip_fences(page)
+        begin = page.find("\\begin{document}")
+        if begin == -1:
+            bodies.append(page)
+            continue
+        for line in page[:begin].splitlines():
+            line = line.strip()
+            if line and line not in seen and not (line.startswith("\\documentclass") and preamble):
+                seen.add(line)
+                preamble.append(line)
+        end = page.rfind("\\end{document}")
+        bodies.append(page[begin + len("\\begin{document}"):end if end > begin else len(page)].strip())
+    body = "\n\n".join(body for body in bodies if body)
+    if not preamble:
+        return body
+    return "\n".join(preamble) + "\n\\begin{document}\n" + body + "\n\\end{document}"
+
+class AsyncClient:
+    """
+    Use as an async context manager so the pooled session is closed:
+
+        async with AsyncClient(api_key) as client:
+            documents = await asyncio.gather(*(client.parse(path, instruction) for path in paths))
+    """
+    def __init__(self, api_key: str, max_concurrency: int = 8, base_url: str | None = None, timeout: float = TIMEOUT,
+                 job_timeout: float = JOB_TIMEOUT, poll_interval: float = POLL_INTERVAL, max_retries: int = MAX_RETRIES):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.base_url = (base_url or BASE_URL).rstrip("/")
+        self.timeout = timeout
+        self.job_timeout = job_timeout
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.session = None
+
+    async def __aenter__(self) -> "AsyncClient":
+        import aiohttp
 
-    # apply post-processing 
-    # this is necessary because llamaparse treats each page as a separate document
+        # bounds the documents being uploaded or polled at once; polling waits don't hold a slot
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"Authorization": f"Bearer {self.api_key}", "Accept": "application/json"},
+        )
+        return self
 
-    # get rid of every \documentclass{article} that is not the first one
-    response = remove_duplicate_substrings(response, "\\documentclass{article}")
+    async def __aexit__(self, *exc) -> None:
+        await self.session.close()
+        self.session = None
 
-    # get rid of every \begin{document} that is not the first one
-    response = remove_duplicate_substrings(response, "\\begin{document}")
+    async def parse(self, path: str, instruction: str = "") -> str:
+        """
+        Parse the document at path and return the merged LaTeX of its pages.
+        """
+        return merge_pages(await self.parse_pages(path, instruction))
 
-    # get rid of every \end{document} that is not the last one
-    response = remove_duplicate_substrings(response, "\\end{document}", first=False)
+    async def parse_pages(self, path: str, instruction: str = "") -> list[str]:
+        """
+        Parse the document at path and return the result for each page.
+        """
+        with trace.span("llamaparse.job", path=path) as attributes:
+            key = cache.cache_key({"llamaparse": await asyncio.to_thread(_file_hash, path), "instruction": instruction})
+            cached = await asyncio.to_thread(cache.get, key)
+            attributes["cache_hit"] = cached is not None
+            if cached is not None:
+                return cached["pages"]
 
-    print(response)
+            job_id = await self._upload(path, instruction)
+            attributes["job_id"] = job_id
+            attributes["polls"] = await self._wait(job_id)
+            result = await self._request("GET", f"/api/parsing/job/{job_id}/result/json")
+            pages = [page.get("md") or page.get("text") or "" for page in result.get("pages", [])]
+            attributes["pages"] = len(pages)
+            await asyncio.to_thread(cache.put, key, {"pages": pages})
+            return pages
 
-    return response
\ No newline at end of file
+    async def _upload(self, path: str, instruction: str) -> str:
+        import aiohttp
+
+        with open(path, "rb") as f:
+            data = await asyncio.to_thread(f.read)
+
+        def form() -> aiohttp.FormData:
+            # a FormData can only be sent once, so each attempt builds its own
+            form = aiohttp.FormData()
+            form.add_field("file", data, filename=os.path.basename(path), content_type="application/pdf")
+            form.add_field("parsing_instruction", instruction)
+            return form
+
+        response = await self._request("POST", "/api/parsing/upload", data=form)
+        return response["id"]
+
+    async def _wait(self, job_id: str) -> int:
+        # poll until the job succeeds, with a growing interval; returns the number of polls
+        deadline = time.monotonic() + self.job_timeout
+        interval = self.poll_interval
+        polls = 0
+        while True:
+            await asyncio.sleep(interval * random.uniform(0.8, 1.2))
+            polls += 1
+            status = (await self._request("GET", f"/api/parsing/job/{job_id}")).get("status", "").upper()
+            if status == "SUCCESS":
+                return polls
+            if status in FAILED_STATUSES:
+                raise RuntimeError(f"LlamaParse job {job_id} finished with status {status}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"LlamaParse job {job_id} did not finish within {self.job_timeout} seconds")
+            interval = min(POLL_CAP, interval * POLL_BACKOFF)
+
+    async def _request(self, method: str, route: str, data=None) -> dict:
+        import aiohttp
+        from spec_to_tex.wrappers.openai import _backoff
+
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                try:
+                    async with self.session.request(method, self.base_url + route, data=data() if data else None) as response:
+                        if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                            delay = _backoff(attempt, response.headers.get("Retry-After"))
+                        else:
+                            response.raise_for_status()
+                            return await response.json(content_type=None)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == self.max_retries:
+                        raise
+                    delay = _backoff(attempt)
+            await asyncio.sleep(delay)
+
+async def parse_documents(paths: list[str], instruction: str = "", api_key: str | None = None, **options) -> list[str]:
+    """
+    Parse many documents concurrently and return the merged LaTeX of each, in order.
+    """
+    async with AsyncClient(api_key or os.getenv("LLAMA_CLOUD_API_KEY"), **options) as client:
+        return await asyncio.gather(*(client.parse(path, instruction) for path in paths))
+
+def shared_client() -> tuple[asyncio.AbstractEventLoop, AsyncClient]:
+    """
+    Return the event loop and client used by get_response, starting the loop on a background thread and
+    opening the client's session on first use. The session is closed when the process exits.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llamaparse", daemon=True).start()
+            client = AsyncClient(os.getenv("LLAMA_CLOUD_API_KEY"))
+            asyncio.run_coroutine_threadsafe(client.__aenter__(), loop).result()
+            atexit.register(lambda: asyncio.run_coroutine_threadsafe(client.__aexit__(), loop).result())
+            _shared = loop, client
+        return _shared
+
+async def _run_in(context: contextvars.Context, coroutine):
+    # a task copies the context it is created in, so the caller's trace span is the parent of the job's
+    return await context.run(asyncio.ensure_future, coroutine)
+
+def get_response(prompt: str, document_path: str) -> str:
+    """
+    Parse one document, blocking until it is done. Safe to call from many threads at once.
+    """
+    loop, client = shared_client()
+    coroutine = _run_in(contextvars.copy_context(), client.parse(document_path, prompt))
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
@@ -1,13 +1,97 @@
 """
 Simple OpenAI API wrapper to use GPT-4V with structured output.
+
+`Client` issues blocking requests over a shared, pooled `requests.Session`, and can stream completions; it is
+safe to use from many threads at once, which is how chunks, windows and batch or service documents are
+converted concurrently. `AsyncClient` issues requests concurrently over a single pooled aiohttp session.
+Both pass every request through one token bucket (see `limiter`) that limits requests and tokens per minute
+across the process, and retry on 429/5xx responses, honouring `Retry-After` and otherwise backing off
+exponentially with jitter. Error responses left after retrying raise `APIError`.
+
+Set `OPENAI_BASE_URL` to point either client at a different endpoint, e.g. a local stub server, and
+`OPENAI_REQUESTS_PER_MINUTE` / `OPENAI_TOKENS_PER_MINUTE` to the limits of your account (or call `configure`).
+Both clients use `DEFAULT_MODEL` unless given another model.
+
+The system message and the schema instructions are sent first, as the system message, so that repeated requests
+share a prefix the API can serve from its prompt cache.
 """
 
+import asyncio
+import base64
+import functools
 import json
-import requests
-from utils.cache import lru_cache
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+from utils import cache, trace
 from pydantic import BaseModel
 
+if TYPE_CHECKING:
+    import requests
+
+BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+DEFAULT_MODEL = "gpt-4o-mini"
+TIMEOUT = 300  # seconds; vision completions for long documents can take minutes
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 500))
+TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", 200_000))
+POOL_SIZE = 16  # connections kept open to the API; at least the number of requests in flight at once
+
+_session = None
+_session_lock = threading.Lock()
+_limiter = None
+
+def session() -> "requests.Session":
+    """
+    Return the shared session, importing requests and creating it on first use (cached runs never need it).
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            # the default pool keeps 10 connections, fewer than batch runs have requests in flight
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def limiter() -> "RateLimiter":
+    """
+    Return the rate limiter shared by every request in the process, creating it on first use.
+    """
+    global _limiter
+    with _session_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        return _limiter
+
+def configure(pool_size: int | None = None, requests_per_minute: float | None = None, tokens_per_minute: float | None = None) -> None:
+    """
+    Set the connection pool size and rate limits, before the first request is sent.
+    """
+    global POOL_SIZE, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+    POOL_SIZE = max(POOL_SIZE, pool_size or 0)
+    REQUESTS_PER_MINUTE = requests_per_minute or REQUESTS_PER_MINUTE
+    TOKENS_PER_MINUTE = tokens_per_minute or TOKENS_PER_MINUTE
+
+class APIError(RuntimeError):
+    """
+    An error response from the API (bad key or request, exhausted quota...), rather than a completion.
+    """
+
 def parse_output(response: dict) -> dict:
+    if "choices" not in response:
+        error = response.get("error")
+        message = error.get("message") if isinstance(error, dict) else error
+        raise APIError(f"OpenAI API error: {message or response}")
     try:
         output = (response['choices'][0]['message']['content'])
         output = json.loads(output)
@@ -16,7 +100,8 @@ def parse_output(response: dict) -> dict:
         raise e
     return output
 
-def _get_headers_and_payload(api_key: str, prompt: str, system_message: str | None = None, images : list | None = None) -> dict:
+def _get_headers_and_payload(api_key: str, prompt: str, system_message: str | None = None, images : list | None = None,
+                             model: str = DEFAULT_MODEL) -> dict:
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
@@ -33,7 +118,7 @@ def _get_headers_and_payload(api_key: str, prompt: str, system_message: str | No
     } if system_message else None
 
     payload = {
-        "model": "gpt-4o-mini",
+        "model": model,
         "response_format":{"type": "json_object"},
         "messages": [
 
@@ -56,7 +141,13 @@ def _get_headers_and_payload(api_key: str, prompt: str, system_message: str | No
         idx = 1
 
     if images:
+        # pages may be split into several tiles, or dropped (None) when blank
+        images = [tile for image in images if image is not None for tile in (image if isinstance(image, list) else [image])]
         for image in images:
+            if isinstance(image, dict):
+                # a page sent as its extracted text layer, already in content-part form
+                payload["messages"][idx]["content"].append(image)
+                continue
             payload["messages"][idx]["content"].append(
                 {
                     "type": "image_url",
@@ -69,28 +160,298 @@ def _get_headers_and_payload(api_key: str, prompt: str, system_message: str | No
 
     return headers, payload
 
-@lru_cache
-def get_response(api_key: str, prompt: str, system_message: str | None = None, images: list | None = None) -> dict:
-    headers, payload = _get_headers_and_payload(api_key, prompt, system_message, images)
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    return response.json()
+def estimate_tokens(payload: dict) -> int:
+    """
+    Roughly estimate the number of input tokens in a payload, for rate limiting.
+
+    Text is counted at ~4 characters per token; images as the API bills them for their size (see image_tokens).
+    """
+    tokens = 0
+    for message in payload["messages"]:
+        for part in message["content"]:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            else:
+                tokens += image_tokens(part["image_url"])
+    return tokens
+
+def image_tokens(image_url: dict) -> int:
+    """
+    Estimate the input tokens of an image content part: 85 at low detail, otherwise from the image's size as
+    read from its JPEG header (see spec_to_tex.preprocess), or the cost of a full letter page (765) if the size
+    can't be read.
+    """
+    if image_url.get("detail") == "low":
+        return 85
+    from spec_to_tex.preprocess import estimate_image_tokens, jpeg_size
+
+    encoded = image_url["url"].partition(",")[2]
+    # the frame header comes right after the quantization tables, within the first few hundred bytes
+    size = jpeg_size(base64.b64decode(encoded[:4096]))
+    if size is None:
+        size = jpeg_size(base64.b64decode(encoded))
+    return estimate_image_tokens(*size) if size else 765
+
+def _backoff(attempt: int, retry_after: str | None = None) -> float:
+    """
+    Seconds to wait before retry number `attempt` (from 0): Retry-After if the server sent one,
+    otherwise exponential backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def _post(headers: dict, payload: dict, stream: bool = False) -> "requests.Response":
+    # POST with retries on connection errors and 429/5xx (a stream that fails midway is not retried)
+    import requests
+
+    tokens = estimate_tokens(payload)
+    for attempt in range(MAX_RETRIES + 1):
+        limiter().wait(tokens)
+        try:
+            response = session().post(f"{BASE_URL}/chat/completions", headers=headers, json=payload, timeout=TIMEOUT, stream=stream)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(_backoff(attempt))
+            continue
+        if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+            time.sleep(_backoff(attempt, response.headers.get("Retry-After")))
+            response.close()
+            continue
+        trace.annotate(retries=attempt, status=response.status_code)
+        return response
+
+def _call_attributes(payload: dict) -> dict:
+    # span attributes describing a request, before it is sent
+    parts = [part for message in payload["messages"] for part in message["content"] if part["type"] == "image_url"]
+    return {"model": payload["model"], "images": len(parts), "image_tokens": sum(image_tokens(part["image_url"]) for part in parts)}
+
+def _usage_attributes(result: dict) -> dict:
+    usage = result.get("usage") or {}
+    # cached_tokens: the part of the prompt served from the API's prompt cache (see system_prompt)
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    return {"prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0), "cached_tokens": cached}
+
+def get_response(api_key: str, prompt: str, system_message: str | None = None, images: list | None = None,
+                 model: str = DEFAULT_MODEL) -> dict:
+    headers, payload = _get_headers_and_payload(api_key, prompt, system_message, images, model)
+
+    with trace.span("openai.chat", **_call_attributes(payload)) as attributes:
+        # the key only covers the payload, so the API key never ends up in the cache
+        key = cache.cache_key(payload)
+        cached = cache.get(key)
+        attributes["cache_hit"] = cached is not None
+        if cached is not None:
+            return cached
+
+        response = _post(headers, payload)
+        result = response.json()
+        attributes.update(_usage_attributes(result))
+        if "choices" in result:  # don't cache errors
+            cache.put(key, result)
+        return result
+
+def stream_response(api_key: str, prompt: str, on_delta: Callable[[str], None], system_message: str | None = None, images: list | None = None,
+                    model: str = DEFAULT_MODEL) -> dict:
+    """
+    Like get_response, but streams the completion (server-sent events), calling on_delta with each piece of
+    content as it arrives. Returns the assembled response, which is cached like a non-streamed one if the stream
+    completed (ended with `data: [DONE]`, or finished with reason "stop"); a stream cut off early is returned
+    as far as it got but not cached, so the next request for it is sent again.
+    """
+    headers, payload = _get_headers_and_payload(api_key, prompt, system_message, images, model)
+
+    with trace.span("openai.chat", stream=True, **_call_attributes(payload)) as attributes:
+        # streamed and non-streamed requests for the same payload share a cache entry
+        key = cache.cache_key(payload)
+        cached = cache.get(key)
+        attributes["cache_hit"] = cached is not None
+        if cached is not None:
+            on_delta(cached["choices"][0]["message"]["content"])
+            return cached
+
+        response = _post(headers, {**payload, "stream": True, "stream_options": {"include_usage": True}}, stream=True)
+        if response.status_code != 200:
+            return response.json()
+
+        content = []
+        usage = finish_reason = None
+        done = False
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    done = True
+                    break
+                event = json.loads(data)
+                usage = event.get("usage") or usage
+                choices = event.get("choices") or [{}]
+                finish_reason = choices[0].get("finish_reason") or finish_reason
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    if not content:
+                        attributes["first_token_seconds"] = (time.time_ns() - trace.current()["start_time_unix_nano"]) / 1e9
+                    content.append(delta)
+                    on_delta(delta)
+
+        result = {"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(content)},
+                               "finish_reason": finish_reason}], "usage": usage}
+        attributes.update(_usage_attributes(result))
+        attributes["complete"] = done or finish_reason == "stop"
+        if attributes["complete"]:
+            cache.put(key, result)
+        return result
+
+@functools.cache
+def schema_instructions(schema: type[BaseModel]) -> str:
+    """
+    Return the instructions asking for a JSON object that conforms to schema, computed once per model class.
+    """
+    return "Respond with a JSON object that conforms to the following JSON schema:\n" + json.dumps(schema.model_json_schema(), sort_keys=True)
+
+@functools.cache
+def system_prompt(system_message: str | None, schema: type[BaseModel] | None) -> str | None:
+    """
+    Return the system message followed by the schema instructions.
+
+    Requests put everything static first, in the system message, and the prompt and images after it, so
+    requests with the same system message and schema share a prefix that the API can cache.
+    """
+    parts = [part for part in (system_message and system_message.strip(), schema and schema_instructions(schema)) if part]
+    return "\n\n".join(parts) or None
 
 class Client:
-    def __init__(self, api_key: str, schema: BaseModel | None = None, system_message: str | None = None):
+    def __init__(self, api_key: str, schema: BaseModel | None = None, system_message: str | None = None, model: str = DEFAULT_MODEL):
         self.api_key = api_key
         self.schema = schema
         self.system_message = system_message
+        self.model = model
         
 
     def get_response(self, prompt: str, schema: BaseModel | None = None, system_message: str | None = None, images: list | None = None) -> dict:
-        schema = schema if schema else self.schema
-        
-        if schema:
-            prompt = f"""
-                Respond to the following prompt with a JSON object that conforms to the following schema:
-                {schema.model_json_schema()}
-                Prompt: 
-                {prompt}
-            """
-        
-        return parse_output(get_response(self.api_key, prompt, system_message or self.system_message, images))
\ No newline at end of file
+        system = system_prompt(system_message or self.system_message, schema or self.schema)
+        return parse_output(get_response(self.api_key, prompt, system, images, self.model))
+
+    def stream_response(self, prompt: str, on_delta: Callable[[str], None], schema: BaseModel | None = None, system_message: str | None = None, images: list | None = None) -> dict:
+        system = system_prompt(system_message or self.system_message, schema or self.schema)
+        return parse_output(stream_response(self.api_key, prompt, on_delta, system, images, self.model))
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute, shared by threads and async tasks.
+
+    Each bucket holds up to a minute's allowance and refills continuously, so short bursts are allowed
+    but the sustained rate never exceeds the limits.
+    """
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.capacity = (float(requests_per_minute), float(tokens_per_minute))
+        self.available = list(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for i, capacity in enumerate(self.capacity):
+            self.available[i] = min(capacity, self.available[i] + elapsed * capacity / 60)
+
+    def _take(self, tokens: int) -> float:
+        # take a request and tokens from the buckets if they hold enough, and return 0; otherwise return how
+        # long to wait. A request larger than a minute's allowance waits for a full bucket rather than forever
+        needed = (1.0, min(float(tokens), self.capacity[1]))
+        with self.lock:
+            self._refill()
+            wait = max((needed[i] - self.available[i]) * 60 / self.capacity[i] for i in range(2))
+            if wait <= 0:
+                for i in range(2):
+                    self.available[i] -= needed[i]
+            return wait
+
+    def wait(self, tokens: int) -> None:
+        while (delay := self._take(tokens)) > 0:
+            time.sleep(delay)
+
+    async def acquire(self, tokens: int) -> None:
+        while (delay := self._take(tokens)) > 0:
+            await asyncio.sleep(delay)
+
+class AsyncClient:
+    """
+    asyncio counterpart of `Client`. Use as an async context manager so the pooled session is closed:
+
+        async with AsyncClient(api_key, schema=TeXDocument) as client:
+            responses = await asyncio.gather(*(client.get_response(prompt, images=doc) for doc in docs))
+    """
+    def __init__(self, api_key: str, schema: BaseModel | None = None, system_message: str | None = None,
+                 max_concurrency: int = 8, requests_per_minute: float | None = None, tokens_per_minute: float | None = None,
+                 base_url: str | None = None, timeout: float = TIMEOUT, max_retries: int = MAX_RETRIES, model: str = DEFAULT_MODEL):
+        self.api_key = api_key
+        self.schema = schema
+        self.system_message = system_message
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.url = f"{base_url or BASE_URL}/chat/completions"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # the process-wide limiter, unless given limits of its own
+        self.limiter = (RateLimiter(requests_per_minute or REQUESTS_PER_MINUTE, tokens_per_minute or TOKENS_PER_MINUTE)
+                        if requests_per_minute or tokens_per_minute else limiter())
+        self.session = None
+
+    async def __aenter__(self) -> "AsyncClient":
+        import aiohttp
+
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.session.close()
+        self.session = None
+
+    async def get_response(self, prompt: str, schema: BaseModel | None = None, system_message: str | None = None, images: list | None = None) -> dict:
+        system = system_prompt(system_message or self.system_message, schema or self.schema)
+        headers, payload = _get_headers_and_payload(self.api_key, prompt, system, images, self.model)
+
+        with trace.span("openai.chat", **_call_attributes(payload)) as attributes:
+            key = cache.cache_key(payload)
+            cached = await asyncio.to_thread(cache.get, key)
+            attributes["cache_hit"] = cached is not None
+            if cached is not None:
+                return parse_output(cached)
+
+            result = await self._post(headers, payload)
+            attributes.update(_usage_attributes(result))
+            if "choices" in result:
+                await asyncio.to_thread(cache.put, key, result)
+            return parse_output(result)
+
+    async def _post(self, headers: dict, payload: dict) -> dict:
+        import aiohttp
+
+        tokens = estimate_tokens(payload)
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire(tokens)
+                try:
+                    async with self.session.post(self.url, headers=headers, json=payload) as response:
+                        if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                            delay = _backoff(attempt, response.headers.get("Retry-After"))
+                        else:
+                            trace.annotate(retries=attempt, status=response.status)
+                            return await response.json(content_type=None)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == self.max_retries:
+                        raise
+                    delay = _backoff(attempt)
+                await asyncio.sleep(delay)
\ No newline at end of file
@@ -1,63 +1,162 @@
 """
-Implementation for a LRU Cache Decorator
+Implementation for a content-addressed, on-disk response cache
 
-This helps reduce API calls by caching the results of a function
+This helps reduce API calls by caching the responses to requests.
+
+Entries are keyed by the SHA-256 digest of the normalized request payload and stored
+one file per entry, sharded into subdirectories by the first two hex digits of the key:
+
+    cache/ab/abcdef0123....json
+
+Lookups and inserts touch a single file, so their cost does not depend on the size of the cache.
+Eviction walks the whole cache, so inserts only trigger it once every EVICT_INTERVAL seconds across all
+processes sharing the directory: the sweep is claimed with a lock file, and its time recorded in a marker.
+Between sweeps the cache can grow past CACHE_MAX_BYTES by whatever is written in the meantime.
+Writes go to a temporary file that is atomically renamed into place, so several processes can
+share the cache directory without ever observing a partially written entry.
+
+Files at the top of the cache directory, such as the page index (see spec_to_tex.pageindex), are not
+entries: eviction leaves them alone, and only clear_cache removes them.
 """
 
-import pickle
+import hashlib
+import json
 import os
-from collections import OrderedDict
+import shutil
+import tempfile
+import time
+
+CACHE_DIR = "cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # evict least recently used entries beyond this total size
+CACHE_MAX_AGE = 30 * 24 * 60 * 60    # entries older than this (in seconds) are treated as misses
+EVICT_INTERVAL = 10 * 60             # minimum seconds between eviction sweeps triggered by inserts
+_EVICT_MARKER = ".last-evict"        # at the top of CACHE_DIR; its mtime is when the last sweep started
+_EVICT_LOCK = ".evict.lock"          # held (created exclusively) by the process running a sweep
+
+def cache_key(payload: dict) -> str:
+    """
+    Return the SHA-256 digest of a normalized (key-sorted, compact) JSON encoding of the payload.
+
+    The payload should not contain credentials, so that entries are shared across API keys.
+    """
+    normalized = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
 
-CACHE_PATH = "cache/cache.pkl"
-CACHE_LIMIT = 100
+def _entry_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], key + ".json")
 
-def load_cache() -> OrderedDict:
+def get(key: str) -> dict | None:
+    """
+    Return the cached value for the key, or None on a miss.
+    """
+    path = _entry_path(key)
     try:
-        with open(CACHE_PATH, "rb") as f:
-            return pickle.load(f)
-    except:
-        return OrderedDict()  # Return an empty ordered dictionary if no cache file exists
-    
-def save_cache(cache: OrderedDict) -> None:
-    folder = os.path.dirname(CACHE_PATH)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-    with open(CACHE_PATH, "wb") as f:
-        pickle.dump(cache, f)
+        if time.time() - os.path.getmtime(path) > CACHE_MAX_AGE:
+            _remove(path)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            value = json.load(f)
+        os.utime(path)  # mark as recently used
+        return value
+    except (OSError, ValueError):
+        # missing, concurrently evicted, or corrupt entries are all misses
+        return None
 
-def clear_cache() -> None:
-    if os.path.exists(CACHE_PATH):
-        os.remove(CACHE_PATH)
+def put(key: str, value: dict) -> None:
+    """
+    Atomically store the value under the key.
+    """
+    path = _entry_path(key)
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
 
-def lru_cache(func):
-    cache = load_cache()  # Load existing cache
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
 
-    def make_hashable(item):
-        if isinstance(item, list):
-            return tuple(item)
-        elif isinstance(item, dict):
-            return frozenset((k, make_hashable(v)) for k, v in item.items())
-        return item
+    _maybe_evict()
 
-    def wrapper(*args, **kwargs):
-        hashable_args = tuple(make_hashable(arg) for arg in args)
-        hashable_kwargs = frozenset((k, make_hashable(v)) for k, v in kwargs.items())
+def _maybe_evict() -> None:
+    """
+    Run evict() if no sweep has started in the last EVICT_INTERVAL seconds and no other process is running one.
+    """
+    marker = os.path.join(CACHE_DIR, _EVICT_MARKER)
+    now = time.time()
+    try:
+        if now - os.path.getmtime(marker) < EVICT_INTERVAL:
+            return
+    except OSError:
+        pass  # never swept
 
-        key = (hashable_args, hashable_kwargs)
+    lock = os.path.join(CACHE_DIR, _EVICT_LOCK)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if now - os.path.getmtime(lock) > 60 * 60:
+                _remove(lock)  # left behind by a crashed sweep; the next insert retries
+        except OSError:
+            pass
+        return
+    except OSError:
+        return
+    os.close(fd)
+    try:
+        with open(marker, "a"):
+            pass
+        os.utime(marker)
+        evict()
+    finally:
+        _remove(lock)
 
-        if key in cache:
-            cache.move_to_end(key)  # Mark as recently used
-            return cache[key]
+def evict(max_bytes: int = None, max_age: float = None) -> None:
+    """
+    Remove expired entries, then least recently used entries until the cache fits in max_bytes.
+    Only entries (in the shard subdirectories) count and are removed.
+    """
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age = CACHE_MAX_AGE if max_age is None else max_age
+    now = time.time()
 
-        result = func(*args, **kwargs)
-        cache[key] = result
-        cache.move_to_end(key)
+    entries = []
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith(".tmp-"):
+                # leftovers from a crashed writer; live writers finish well within an hour
+                if now - stat.st_mtime > 60 * 60:
+                    _remove(path)
+                continue
+            if root == CACHE_DIR:
+                continue
+            if now - stat.st_mtime > max_age:
+                _remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
 
-        if len(cache) > CACHE_LIMIT:
-            cache.popitem(last=False)  # Remove least recently used item
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        _remove(path)
+        total -= size
 
-        save_cache(cache)
-        return result
+def clear_cache() -> None:
+    if os.path.exists(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
 
-    return wrapper
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
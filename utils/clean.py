@@ -1,29 +1,370 @@
-import regex as re
+"""
+Cleaning of generated LaTeX documents
+
+`clean_doc` repairs the mistakes models commonly make, in a single left-to-right pass over the document, so
+they don't cost a round trip to fix:
+- duplicated \\begin{document} / \\end{document} tags (the first begin and one final end are kept)
+- environments that are never closed (closed at the end of the document; math at the end of the paragraph)
+  and \\end tags without a matching \\begin (removed); environments ended out of order are closed in order
+- special characters (& % $ # _) that aren't escaped in text mode; they are left alone in verbatim,
+  comments, the preamble, the arguments of commands such as \\label and \\url, command definitions
+  (\\newcommand, \\def, \\DeclareMathOperator...), and (for &) alignment
+  environments such as tabular. In math, only a stray & or $, a #, or a % that reads as a percentage, is escaped
+- math that is never closed (closed at the end of the line, for inline math)
+- packages loaded more than once with \\usepackage
+
+The pass jumps between the characters that need attention, and every lookahead is either bounded by the
+current paragraph or consumes what it scans, so cleaning takes time linear in the size of the document.
+"""
+
+import re
+from utils.validate import (ALIGNMENT_ENVIRONMENTS, DEFINITION_COMMANDS, MATH_ENVIRONMENTS, RAW_ARGUMENT_COMMANDS,
+                            VERBATIM_ENVIRONMENTS, definition_end)
+
+# environments that may appear inside math
+_INNER_MATH_ENVIRONMENTS = ALIGNMENT_ENVIRONMENTS - MATH_ENVIRONMENTS
+
+# a comment line, or a character that may need attention
+_TOKEN = re.compile(r"(?:^|\n)[ \t]*%|[\\%$&#_]")
+_PARAGRAPH = re.compile(r"\n[ \t]*\n")
+_COMMAND = re.compile(r"\\([a-zA-Z]+)")
+_ENVIRONMENT = re.compile(r"\\(begin|end)\s*\{([^}]*)\}")
+_BOUNDARY = re.compile(r"\\(?:begin|end)\s*\{|\\[\[(]|(?<!\\)\$|\\(?:%s)(?![a-zA-Z])"
+                       % "|".join(sorted(RAW_ARGUMENT_COMMANDS | DEFINITION_COMMANDS)))
+_AMPERSAND = re.compile(r"(?<!\\)&")
+_HASH = re.compile(r"(?<!\\)#")
+_DEFINITION = re.compile(r"\\(?:%s)(?![a-zA-Z])" % "|".join(sorted(DEFINITION_COMMANDS)))
+_DOLLAR = re.compile(r"(?<!\\)\$")
+_TEXT_COMMAND = re.compile(r"\\(?:text|mbox)(?![a-zA-Z])")
+_COMMENT = re.compile(r"(?<!\S)%")
+_PERCENT = re.compile(r"(?<=[^\s\\])%")
+_MATH_DELIMITERS = ("\\(", "\\)", "\\[", "\\]")
+_USEPACKAGE = re.compile(r"\\usepackage\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}")
+
+def _is_math(content: str) -> bool:
+    # whether the text between a pair of math delimiters can be math: it mustn't contain other math delimiters
+    # or text environments
+    return (not any(other in content for other in _MATH_DELIMITERS)
+            and all(tag.group(2).strip() in _INNER_MATH_ENVIRONMENTS for tag in _ENVIRONMENT.finditer(content)))
+
+def _escape_hashes(text: str) -> str:
+    # a # in math is a stray character too, except for the parameters in a definition inside the math
+    if "#" not in text:
+        return text
+    out, i = [], 0
+    for match in _DEFINITION.finditer(text):
+        end = definition_end(text, match.start(), len(text)) if match.start() >= i else -1
+        if end != -1:
+            out.append(_HASH.sub(r"\\#", text[i:match.start()]) + text[match.start():end])
+            i = end
+    return "".join(out) + _HASH.sub(r"\\#", text[i:])
+
+def _math(text: str) -> str:
+    # "50%" is a percentage, not a comment; & only separates columns inside an alignment environment
+    text = _escape_hashes(_PERCENT.sub(r"\\%", text))
+    if "&" not in text or "\\begin" in text:
+        return text
+    return _AMPERSAND.sub(r"\\&", text)
+
+def _math_environment(text: str) -> str:
+    # $ only belongs in a display math environment inside text, as in \text{$x$}
+    text = _escape_hashes(_PERCENT.sub(r"\\%", text))
+    if "$" not in text or _TEXT_COMMAND.search(text):
+        return text
+    return _DOLLAR.sub(r"\\$", text)
+
+def _find_unescaped(doc: str, target: str, start: int, end: int) -> int:
+    while True:
+        index = doc.find(target, start, end)
+        if index == -1:
+            return -1
+        backslashes = 0
+        while index - backslashes > 0 and doc[index - backslashes - 1] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return index
+        start = index + 1
+
+def _group_end(doc: str, start: int, end: int) -> int:
+    # the index just after the brace group opening at start, or -1 if it isn't closed before end
+    depth = 0
+    i = start
+    while i < end:
+        c = doc[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return -1
 
 def clean_doc(doc: str) -> str:
     """
     Clean a provided document up by catching any programmatic errors.
     """
-    # Case 1: Double \end{document} tags
-    # Only retain the last \end{document} tag
-    if doc.count(r'\end{document}') > 1:
-        doc = re.sub(r'\\end\{document\}', '', doc)
-        doc += r'\end{document}'
-
-    # Case 2: Double \begin{document} tags
-    # Only retain the first \begin{document} tag
-    tags = re.findall(r'\\begin\{document\}', doc)
-
-    if len(tags) > 1:
-        # get idx of first \begin{document}
-        idx = doc.index(tags[0])
-        # get rid of all the tags
-        doc = re.sub(r'\\begin\{document\}', '', doc)
-        # add back the first tag
-        doc = doc[:idx] + tags[0] + doc[idx:]
-
-    # Case 3: Not escaping special characters
-    # Escape ampersands not already escaped
-    doc = re.sub(r'(?<!\\) &', ' \&', doc)
-
-    return doc
\ No newline at end of file
+    n = len(doc)
+    out = []
+    stack = []             # names of the open environments
+    open_counts = {}       # name -> number of open environments with that name
+    alignment_depth = 0    # number of open environments in which & separates columns
+    packages = set()
+    found = {}             # string -> (position searched from, first occurrence after it or -1), to avoid rescanning
+    paragraph = [0, -1]    # the last paragraph end found, and the position it was searched from
+    # a document without a preamble is all body
+    in_body = "\\begin{document}" not in doc
+
+    def paragraph_end(start: int) -> int:
+        if not paragraph[1] <= start < paragraph[0]:
+            match = _PARAGRAPH.search(doc, start)
+            paragraph[:] = [match.start() if match else n, start]
+        return paragraph[0]
+
+    def find_end(tag: str, start: int) -> int:
+        searched, index = found.get(tag, (n + 1, -1))
+        if searched <= start and (index == -1 or start <= index):
+            return index
+        index = doc.find(tag, start)
+        found[tag] = (start, index)
+        return index
+
+    def find_unescaped(target: str, start: int, stop: int) -> int:
+        # the first unescaped occurrence of target in doc[start:stop], or -1; like find_end, the search is
+        # remembered, so the openers of a long paragraph that is never closed don't each rescan it
+        key = ("unescaped", target)
+        searched, index = found.get(key, (n + 1, -1))
+        if not (searched <= start and (index == -1 or start <= index)):
+            index = _find_unescaped(doc, target, start, n)
+            found[key] = (start, index)
+        return index if index < stop else -1
+
+    def is_math(begin: int, close: int) -> bool:
+        # _is_math(doc[begin:close]), finding the other delimiters with remembered searches
+        if any(begin <= find_end(other, begin) < close for other in _MATH_DELIMITERS):
+            return False
+        return all(tag.group(2).strip() in _INNER_MATH_ENVIRONMENTS for tag in _ENVIRONMENT.finditer(doc, begin, close))
+
+    def push(name: str) -> None:
+        nonlocal alignment_depth
+        stack.append(name)
+        open_counts[name] = open_counts.get(name, 0) + 1
+        alignment_depth += name in ALIGNMENT_ENVIRONMENTS
+
+    def pop() -> str:
+        nonlocal alignment_depth
+        name = stack.pop()
+        open_counts[name] -= 1
+        alignment_depth -= name in ALIGNMENT_ENVIRONMENTS
+        return name
+
+    def environment(match: re.Match) -> int:
+        # handle a \begin or \end tag; returns the position to continue from
+        nonlocal in_body
+        kind, name = match.group(1), match.group(2).strip()
+        start, end = match.start(), match.end()
+        if name == "document":
+            if kind == "begin" and not in_body:
+                in_body = True
+                push(name)
+                out.append(match.group(0))
+            # a duplicate \begin{document} is dropped, and \end{document} is added back at the very end
+            return end
+        if not in_body:
+            out.append(match.group(0))
+            return end
+
+        if kind == "begin" and (name in VERBATIM_ENVIRONMENTS or name in MATH_ENVIRONMENTS):
+            # copied as is up to the matching \end
+            tag = f"\\end{{{name}}}"
+            close = find_end(tag, end)
+            if close != -1 and name in VERBATIM_ENVIRONMENTS:
+                out.append(doc[start:close + len(tag)])
+                return close + len(tag)
+            if name in VERBATIM_ENVIRONMENTS:
+                rest = doc[start:].rstrip()
+                if rest.endswith("\\end{document}"):
+                    rest = rest[:-len("\\end{document}")].rstrip()
+                out.append(rest + "\n" + tag)
+                return n
+            # math ends at its \end tag, or at the end of the paragraph if that comes first (display math can't
+            # span paragraphs). It is also closed early where display math begins, a text or math environment
+            # begins, or an environment ends that wasn't opened inside it
+            if close != -1 and _COMMENT.search(doc, doc.rfind("\n", 0, close) + 1, close):
+                close = -1  # the \end tag is commented out
+            stop = paragraph_end(end)
+            stop = stop if close == -1 else min(close, stop)
+            display = doc.find("\\[", end, stop)
+            stop = stop if display == -1 else display
+            inner = []
+            for other in _ENVIRONMENT.finditer(doc, end, stop):
+                other_name = other.group(2).strip()
+                line_start = max(end, doc.rfind("\n", end, other.start()) + 1)
+                if _COMMENT.search(doc, line_start, other.start()):
+                    continue
+                if other.group(1) == "begin" and other_name in _INNER_MATH_ENVIRONMENTS:
+                    inner.append(other_name)
+                elif inner and inner[-1] == other_name:
+                    inner.pop()
+                else:
+                    stop = other.start()
+                    break
+            if stop == close and not inner:
+                out.append(_math_environment(doc[start:close + len(tag)]))
+                return close + len(tag)
+            closers = "".join(f"\\end{{{other_name}}}\n" for other_name in reversed(inner))
+            out.append(_math_environment(doc[start:stop].rstrip()) + "\n" + closers + tag)
+            return close + len(tag) if stop == close else stop
+
+        if kind == "begin":
+            push(name)
+            out.append(match.group(0))
+        elif open_counts.get(name):
+            # close the environments opened inside this one first
+            while stack[-1] != name:
+                out.append(f"\\end{{{pop()}}}")
+            pop()
+            out.append(match.group(0))
+        # otherwise the \end has no matching \begin and is dropped
+        return end
+
+    def usepackage(match: re.Match) -> int:
+        names = [name.strip() for name in match.group(1).split(",")]
+        new = [name for name in dict.fromkeys(names) if name and name not in packages]
+        packages.update(new)
+        if new == names:
+            out.append(match.group(0))
+        elif new:
+            out.append(match.group(0)[:match.start(1) - match.start()] + ",".join(new) + "}")
+        return match.end()
+
+    def raw_arguments(start: int) -> int:
+        # copy the optional arguments and the first argument of a command as is
+        stop = paragraph_end(start)
+        i = start
+        while i < stop and doc[i] in " \t":
+            i += 1
+        while i < stop and doc[i] == "[":
+            close = doc.find("]", i, stop)
+            if close == -1:
+                return start
+            i = close + 1
+        if i < stop and doc[i] == "{":
+            close = _group_end(doc, i, stop)
+            if close != -1:
+                out.append(doc[start:close])
+                return close
+        return start
+
+    def command(start: int) -> int:
+        if start + 1 >= n:
+            out.append("\\")
+            return n
+        following = doc[start + 1]
+        if following in "([" and in_body:
+            # inline or display math; if it isn't closed within the paragraph, it is closed at the end of the
+            # line (before any comment), or before the next environment tag, math, command like \url or definition on it
+            closer = "\\)" if following == "(" else "\\]"
+            stop = paragraph_end(start + 2)
+            close = find_end(closer, start + 2)
+            if start + 2 <= close < stop and is_math(start + 2, close) and find_unescaped("$", start + 2, close) == -1:
+                out.append(_math(doc[start:close + 2]))
+                return close + 2
+            line_end = find_end("\n", start + 2)
+            stop = stop if line_end == -1 else min(stop, line_end)
+            comment = find_unescaped("%", start + 2, stop)
+            stop = stop if comment == -1 else comment
+            tag = _BOUNDARY.search(doc, start + 2, stop)
+            stop = tag.start() if tag else stop
+            # a comment after the closer stays a comment
+            out.append(_math(doc[start:stop].rstrip()) + " " + closer + (" " if stop == comment else ""))
+            return stop
+        match = _COMMAND.match(doc, start)
+        if match is None:
+            # an escaped character or control symbol
+            out.append(doc[start:start + 2])
+            return start + 2
+        name = match.group(1)
+        if name in ("begin", "end"):
+            tag = _ENVIRONMENT.match(doc, start)
+            if tag:
+                return environment(tag)
+        elif name == "usepackage":
+            tag = _USEPACKAGE.match(doc, start)
+            if tag:
+                return usepackage(tag)
+        elif name == "verb" and match.end() < n:
+            delimiter_index = match.end() + (doc[match.end()] == "*")
+            if delimiter_index < n:
+                close = doc.find(doc[delimiter_index], delimiter_index + 1)
+                end = n if close == -1 else close + 1
+                out.append(doc[start:end])
+                return end
+        elif name in DEFINITION_COMMANDS:
+            # copied as is up to the end of the definition, within the paragraph
+            end = definition_end(doc, start, paragraph_end(start))
+            if end != -1:
+                out.append(doc[start:end])
+                return end
+        out.append(match.group(0))
+        if name in RAW_ARGUMENT_COMMANDS:
+            return raw_arguments(match.end())
+        return match.end()
+
+    def dollar(start: int) -> int:
+        # math if closed within the paragraph, otherwise a literal dollar sign
+        delimiter = "$$" if doc.startswith("$$", start) else "$"
+        close = find_unescaped(delimiter, start + len(delimiter), paragraph_end(start))
+        content = doc[start + len(delimiter):close] if close != -1 else ""
+        # "$5 and $10", or a span containing other math or text environments, isn't math
+        price = content[:1].isdigit() and content[-1:].isspace()
+        if close == -1 or price or not _is_math(content):
+            out.append("\\$")
+            return start + 1
+        out.append(_math(doc[start:close + len(delimiter)]))
+        return close + len(delimiter)
+
+    i = 0
+    while i < n:
+        match = _TOKEN.search(doc, i)
+        if match is None:
+            out.append(doc[i:])
+            break
+        start = match.start()
+        out.append(doc[i:start])
+        token = match.group()
+
+        if token.endswith("%") and (token != "%" or start == 0 or not in_body or doc[start - 1] in " \t"):
+            # a comment (a % starting a line or after a space; "50%" is a percentage), copied up to the end of the line
+            end = doc.find("\n", match.end())
+            end = n if end == -1 else end
+            out.append(doc[start:end])
+            i = end
+        elif token == "\\":
+            i = command(start)
+        elif not in_body:
+            out.append(token)
+            i = start + 1
+        elif token == "$":
+            i = dollar(start)
+        elif token == "%":
+            out.append("\\%")
+            i = start + 1
+        elif token == "&":
+            out.append("&" if alignment_depth else "\\&")
+            i = start + 1
+        elif token == "_":
+            out.append("\\_")
+            i = start + 1
+        else:
+            # "Problem #1": macro parameters only belong in definitions, which are copied whole
+            out.append("\\#")
+            i = start + 1
+
+    doc = "".join(out)
+    if stack:
+        doc = doc.rstrip() + "".join(f"\n\\end{{{name}}}" for name in reversed(stack))
+    return doc
@@ -0,0 +1,81 @@
+"""
+Incremental extraction of a string field from a JSON object that arrives in chunks
+
+When a completion is streamed, its JSON content arrives a few characters at a time. `JSONStringStream`
+follows the JSON as it is fed and returns the decoded characters of one top-level string field as soon as
+they arrive, without waiting for (or re-parsing) the whole object. Each call to feed does work proportional
+to the size of the chunk.
+"""
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class JSONStringStream:
+    def __init__(self, field: str):
+        self.field = field
+        self.depth = 0
+        self.last = None        # last significant character outside strings
+        self.key = None         # the most recent key at the top level
+        self.in_string = False
+        self.is_key = False
+        self.is_target = False
+        self.escape = None      # None, or the characters of a pending escape sequence after the backslash
+        self.surrogate = None   # a pending high surrogate from a \u escape
+        self.chars = []         # characters of the current key
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consume the next chunk of JSON and return any new decoded characters of the field's value.
+        """
+        out = []
+        for c in chunk:
+            if self.in_string:
+                decoded = self._string_char(c)
+                if decoded is None:
+                    continue
+                if self.is_target:
+                    out.append(decoded)
+                elif self.is_key:
+                    self.chars.append(decoded)
+            elif c == '"':
+                self.in_string = True
+                self.is_key = self.depth == 1 and self.last in ("{", ",")
+                self.is_target = self.depth == 1 and self.last == ":" and self.key == self.field
+                self.chars = []
+            elif c in "{[":
+                self.depth += 1
+                self.last = c
+            elif c in "}]":
+                self.depth -= 1
+                self.last = c
+            elif not c.isspace():
+                self.last = c
+        return "".join(out)
+
+    def _string_char(self, c: str) -> str | None:
+        # returns the decoded character, or None if c was consumed without producing one
+        if self.escape is not None:
+            self.escape += c
+            if self.escape[0] != "u":
+                self.escape = None
+                return ESCAPES.get(c, c)
+            if len(self.escape) < 5:
+                return None
+            code = int(self.escape[1:], 16)
+            self.escape = None
+            if 0xD800 <= code < 0xDC00:
+                self.surrogate = code
+                return None
+            if 0xDC00 <= code < 0xE000 and self.surrogate is not None:
+                code = 0x10000 + ((self.surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self.surrogate = None
+            return chr(code)
+        if c == "\\":
+            self.escape = ""
+            return None
+        if c == '"':
+            self.in_string = False
+            if self.is_key:
+                self.key = "".join(self.chars)
+            self.last = '"'
+            return None
+        return c
@@ -0,0 +1,152 @@
+"""
+Lightweight tracing of pipeline stages and API calls
+
+Code wraps units of work in `span(name, **attributes)`. Spans nest (per thread/task, via contextvars), record
+their start and end times, and carry attributes such as token counts, cache hits and retries. Once `enable` has
+been called, finished spans are kept in memory (until `reset`); `write_jsonl` writes them one JSON object per line, with OpenTelemetry-style fields
+(trace_id, span_id, parent_span_id, start/end time in unix nanoseconds, attributes, status), and `summary`
+aggregates them per span name.
+
+Threads don't inherit the current span; wrap functions run on a pool with `bind` so their spans nest under
+the span that submitted them.
+"""
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+# USD per million tokens (input, cached input, output); used only for the cost estimates in the summary
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+_current = contextvars.ContextVar("span", default=None)
+_finished = []
+_lock = threading.Lock()
+_enabled = False
+
+def enable(on: bool = True) -> None:
+    """
+    Start (or stop) keeping finished spans. Spans are always opened, so their attributes can be read, but are
+    only kept while enabled, so a long-running process that doesn't trace doesn't accumulate them.
+    """
+    global _enabled
+    _enabled = on
+
+def _id(n_bytes: int) -> str:
+    return os.urandom(n_bytes).hex()
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record a span around the enclosed block. Yields the span's attribute dict, which may be added to.
+    """
+    parent = _current.get()
+    record = {
+        "name": name,
+        "trace_id": parent["trace_id"] if parent else _id(16),
+        "span_id": _id(8),
+        "parent_span_id": parent["span_id"] if parent else None,
+        "start_time_unix_nano": time.time_ns(),
+        "attributes": dict(attributes),
+        "status": "OK",
+    }
+    token = _current.set(record)
+    try:
+        yield record["attributes"]
+    except BaseException as e:
+        record["status"] = "ERROR"
+        record["attributes"]["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        record["end_time_unix_nano"] = time.time_ns()
+        if _enabled:
+            with _lock:
+                _finished.append(record)
+
+def current() -> dict | None:
+    """
+    Return the current span record, if any.
+    """
+    return _current.get()
+
+def annotate(**attributes) -> None:
+    """
+    Add attributes to the current span, if any.
+    """
+    record = _current.get()
+    if record is not None:
+        record["attributes"].update(attributes)
+
+def bind(func: Callable) -> Callable:
+    """
+    Return a wrapper of func that runs under the span current at the time bind was called, for use on other threads.
+    """
+    parent = _current.get()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+def spans() -> list[dict]:
+    with _lock:
+        return list(_finished)
+
+def reset() -> None:
+    with _lock:
+        _finished.clear()
+
+def write_jsonl(path: str) -> None:
+    with open(path, "w") as f:
+        for record in spans():
+            f.write(json.dumps(record) + "\n")
+
+def cost(model: str | None, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    # cached_tokens are the part of prompt_tokens served from the API's prompt cache, at a discount
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+def summary() -> str:
+    """
+    Return a table of count, total and mean latency, tokens (prompt tokens include cached ones), cache hits/misses,
+    retries and estimated cost per span name.
+    """
+    rows = {}
+    for record in spans():
+        row = rows.setdefault(record["name"], {"count": 0, "seconds": 0.0, "prompt": 0, "cached": 0, "completion": 0, "image": 0,
+                                               "hits": 0, "misses": 0, "retries": 0, "cost": 0.0, "errors": 0})
+        attributes = record["attributes"]
+        row["count"] += 1
+        row["seconds"] += (record["end_time_unix_nano"] - record["start_time_unix_nano"]) / 1e9
+        row["errors"] += record["status"] != "OK"
+        row["prompt"] += attributes.get("prompt_tokens", 0)
+        row["cached"] += attributes.get("cached_tokens", 0)
+        row["completion"] += attributes.get("completion_tokens", 0)
+        row["image"] += attributes.get("image_tokens", 0)
+        row["retries"] += attributes.get("retries", 0)
+        if "cache_hit" in attributes:
+            row["hits" if attributes["cache_hit"] else "misses"] += 1
+            if not attributes["cache_hit"]:
+                row["cost"] += cost(attributes.get("model"), attributes.get("prompt_tokens", 0), attributes.get("completion_tokens", 0),
+                                    attributes.get("cached_tokens", 0))
+
+    width = max([len("span")] + [len(name) for name in rows])
+    lines = [f"{'span':<{width}} {'count':>6} {'total s':>9} {'mean s':>8} {'prompt tok':>11} {'cached tok':>11} {'compl tok':>10} "
+             f"{'image tok':>10} {'hit/miss':>9} {'retries':>8} {'cost $':>8} {'errors':>7}"]
+    for name, row in rows.items():
+        lines.append(f"{name:<{width}} {row['count']:>6} {row['seconds']:>9.2f} {row['seconds'] / row['count']:>8.2f} "
+                     f"{row['prompt']:>11} {row['cached']:>11} {row['completion']:>10} {row['image']:>10} "
+                     f"{str(row['hits']) + '/' + str(row['misses']):>9} {row['retries']:>8} {row['cost']:>8.4f} {row['errors']:>7}")
+    return "\n".join(lines)
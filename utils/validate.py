@@ -0,0 +1,302 @@
+"""
+Local validation of generated LaTeX documents
+
+This replaces asking the model whether a document "will render" with checks that run on this machine:
+a fast structural pass over the source, and an optional sandboxed compile with pdflatex or tectonic.
+Each returns a list of human-readable errors, which is empty when the document looks fine.
+"""
+
+import functools
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+MAX_ERRORS = 20
+COMPILE_TIMEOUT = 60  # seconds
+
+# environments whose contents are not parsed as LaTeX
+VERBATIM_ENVIRONMENTS = {"verbatim", "verbatim*", "lstlisting", "minted", "comment", "Verbatim"}
+# environments typeset in math mode
+MATH_ENVIRONMENTS = {
+    "equation", "equation*", "align", "align*", "alignat", "alignat*", "gather", "gather*",
+    "multline", "multline*", "flalign", "flalign*", "eqnarray", "eqnarray*", "displaymath", "math",
+}
+# environments in which & separates columns
+ALIGNMENT_ENVIRONMENTS = {"tabular", "tabular*", "tabularx", "longtable", "array", "matrix", "pmatrix",
+                          "bmatrix", "vmatrix", "Vmatrix", "cases", "split", "aligned", "gathered"} | MATH_ENVIRONMENTS
+
+# commands whose first argument is a name, key, path or URL rather than text
+RAW_ARGUMENT_COMMANDS = {
+    "label", "ref", "eqref", "pageref", "autoref", "cref", "Cref", "cite", "citep", "citet", "nocite",
+    "url", "href", "includegraphics", "input", "include", "bibliography", "bibliographystyle",
+    "documentclass", "graphicspath", "lstinputlisting", "hypersetup",
+}
+# commands that define a command or environment; the name, parameters and definition are taken as is (a
+# definition like x_1 or #1 is only typeset, in math or with its argument, where the command is used)
+DEFINITION_COMMANDS = {"newcommand", "renewcommand", "providecommand", "def", "DeclareMathOperator",
+                       "newenvironment", "renewenvironment", "NewDocumentCommand", "RenewDocumentCommand",
+                       "ProvideDocumentCommand", "DeclareDocumentCommand"}
+# the number of brace groups after the name and optional arguments, where it isn't one: the begin and end
+# code of an environment, and the argument specification and code of a document command
+_DEFINITION_GROUPS = {"newenvironment": 2, "renewenvironment": 2, "NewDocumentCommand": 2, "RenewDocumentCommand": 2,
+                      "ProvideDocumentCommand": 2, "DeclareDocumentCommand": 2}
+
+_USEPACKAGE = re.compile(r"\\usepackage\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}")
+_ENVIRONMENT = re.compile(r"\\(begin|end)\s*\{([^}]*)\}")
+_RAW_ARGUMENT = re.compile(r"\\([a-zA-Z]+)\s*(?:\[[^\]\n]*\]\s*)*\{[^{}\n]*\}")
+_DEFINITION = re.compile(r"\\(%s)(?![a-zA-Z])\*?\s*" % "|".join(sorted(DEFINITION_COMMANDS)))
+_DEFINED_NAME = re.compile(r"\{\s*\\(?:[a-zA-Z@]+|.)\s*\}|\{[a-zA-Z@*]+\}|\\(?:[a-zA-Z@]+|.)")
+_PARAGRAPH = re.compile(r"\n[ \t]*\n")
+
+def _line(doc: str, index: int) -> int:
+    return doc.count("\n", 0, index) + 1
+
+def definition_end(doc: str, start: int, stop: int) -> int:
+    """
+    Return the index just after the definition (\\newcommand{\\name}[1]{...}, \\def\\name#1{...},
+    \\newenvironment{name}[1]{...}{...}, \\NewDocumentCommand{\\name}{m}{...}...) starting at start, or -1 if
+    there isn't a complete one before stop.
+    """
+    match = _DEFINITION.match(doc, start, stop)
+    if match is None:
+        return -1
+    name = _DEFINED_NAME.match(doc, match.end(), stop)
+    if name is None:
+        return -1
+    i = name.end()
+    if match.group(1) == "def":
+        # the parameter text (#1#2, or delimited parameters) runs up to the definition
+        i = doc.find("{", i, stop)
+        if i == -1:
+            return -1
+    else:
+        # [number of arguments][default of the first]
+        while True:
+            while i < stop and doc[i].isspace():
+                i += 1
+            if i == stop or doc[i] != "[":
+                break
+            i = doc.find("]", i, stop)
+            if i == -1:
+                return -1
+            i += 1
+    for group in range(_DEFINITION_GROUPS.get(match.group(1), 1)):
+        while group and i < stop and doc[i].isspace():
+            i += 1
+        if i == stop or doc[i] != "{":
+            return -1
+        depth = 0
+        while i < stop:
+            c = doc[i]
+            if c == "\\":
+                i += 2
+                continue
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    break
+            i += 1
+        else:
+            return -1
+        i += 1
+    return i
+
+def structural_errors(doc: str) -> list[str]:
+    """
+    Check in a single pass that braces, environments and math delimiters are balanced, and that
+    characters that are special in text mode (& _ ^ #) are escaped where they need to be.
+    """
+    errors = []
+
+    def error(index: int, message: str) -> None:
+        if len(errors) < MAX_ERRORS:
+            errors.append(f"line {_line(doc, index)}: {message}")
+
+    environments = []  # stack of (name, index)
+    braces = []        # stack of indices of unclosed {
+    math = None        # the delimiter that opened the current inline/display math, if any
+    math_start = 0
+    i, n = 0, len(doc)
+    while i < n:
+        c = doc[i]
+        if c == "%":
+            end = doc.find("\n", i)
+            i = n if end == -1 else end + 1
+            continue
+        if c == "\\":
+            match = _ENVIRONMENT.match(doc, i)
+            if match:
+                kind, name = match.group(1), match.group(2).strip()
+                if kind == "begin":
+                    environments.append((name, i))
+                    i = match.end()
+                    if name in VERBATIM_ENVIRONMENTS:
+                        end = doc.find(f"\\end{{{name}}}", i)
+                        if end == -1:
+                            error(match.start(), f"\\begin{{{name}}} is never closed")
+                            break
+                        environments.pop()
+                        i = end + len(f"\\end{{{name}}}")
+                elif not environments:
+                    error(i, f"\\end{{{name}}} without a matching \\begin")
+                    i = match.end()
+                else:
+                    open_name, open_index = environments[-1]
+                    if open_name == name:
+                        environments.pop()
+                    elif any(env == name for env, _ in environments):
+                        # close the environments opened inside this one, reporting each
+                        while environments[-1][0] != name:
+                            unclosed, index = environments.pop()
+                            error(index, f"\\begin{{{unclosed}}} is ended by \\end{{{name}}} before it is closed")
+                        environments.pop()
+                    else:
+                        error(i, f"\\end{{{name}}} does not match \\begin{{{open_name}}} on line {_line(doc, open_index)}")
+                    i = match.end()
+                continue
+            if doc.startswith("\\verb", i) and i + 5 < n and not doc[i + 5].isalpha():
+                delimiter_index = i + 6 if doc[i + 5] == "*" else i + 5
+                end = doc.find(doc[delimiter_index], delimiter_index + 1)
+                i = n if end == -1 else end + 1
+                continue
+            raw = _RAW_ARGUMENT.match(doc, i)
+            if raw and raw.group(1) in RAW_ARGUMENT_COMMANDS:
+                i = raw.end()
+                continue
+            if _DEFINITION.match(doc, i):
+                paragraph = _PARAGRAPH.search(doc, i)
+                end = definition_end(doc, i, paragraph.start() if paragraph else n)
+                if end != -1:
+                    i = end
+                    continue
+            nxt = doc[i + 1:i + 2]
+            if nxt in ("(", "["):
+                if math:
+                    error(i, f"\\{nxt} inside math mode")
+                else:
+                    math, math_start = "\\" + nxt, i
+            elif nxt in (")", "]"):
+                expected = "\\(" if nxt == ")" else "\\["
+                if math != expected:
+                    error(i, f"\\{nxt} without a matching {expected}")
+                else:
+                    math = None
+            i += 2  # skip the escaped character or the first letter of the command
+            continue
+        if c == "{":
+            braces.append(i)
+        elif c == "}":
+            if braces:
+                braces.pop()
+            else:
+                error(i, "unmatched }")
+        elif c == "$":
+            delimiter = "$$" if doc.startswith("$$", i) else "$"
+            if math is None:
+                math, math_start = delimiter, i
+            elif math == delimiter:
+                math = None
+            else:
+                error(i, f"{delimiter} inside math opened with {math}")
+            i += len(delimiter)
+            continue
+        else:
+            in_math = math is not None or any(env in MATH_ENVIRONMENTS for env, _ in environments)
+            if c == "&" and not any(env in ALIGNMENT_ENVIRONMENTS for env, _ in environments):
+                error(i, "unescaped & in text (use \\&)")
+            elif c in "_^" and not in_math:
+                error(i, f"unescaped {c} in text mode (use \\{c} or math mode)")
+            elif c == "#":
+                # macro parameters only belong in definitions, which are skipped whole
+                error(i, "unescaped # (use \\#)")
+        i += 1
+
+    if math is not None:
+        error(math_start, f"math mode opened with {math} is never closed")
+    for name, index in reversed(environments):
+        error(index, f"\\begin{{{name}}} is never closed")
+    for index in reversed(braces):
+        error(index, "unmatched {")
+    return errors
+
+@functools.lru_cache(maxsize=None)
+def _package_installed(package: str) -> bool:
+    result = subprocess.run(["kpsewhich", f"{package}.sty"], capture_output=True, text=True)
+    return bool(result.stdout.strip())
+
+def package_errors(doc: str) -> list[str]:
+    """
+    Check that every package loaded with \\usepackage is installed in the local TeX tree.
+
+    Skipped (no errors) when kpsewhich is not available.
+    """
+    if shutil.which("kpsewhich") is None:
+        return []
+    errors = []
+    for match in _USEPACKAGE.finditer(doc):
+        for package in match.group(1).split(","):
+            package = package.strip()
+            if package and not _package_installed(package):
+                errors.append(f"line {_line(doc, match.start())}: package '{package}' is not installed (no {package}.sty found)")
+    return errors
+
+def compile_errors(doc: str, engine: str | None = None, timeout: float = COMPILE_TIMEOUT) -> list[str]:
+    """
+    Compile the document in a throwaway directory with shell escape disabled and return the errors from the log.
+
+    `engine` is 'pdflatex' or 'tectonic'; by default whichever is installed is used.
+    Skipped (no errors) when neither is available.
+    """
+    engine = engine or next((e for e in ("pdflatex", "tectonic") if shutil.which(e)), None)
+    if engine is None or shutil.which(engine) is None:
+        return []
+
+    with tempfile.TemporaryDirectory(prefix="spec-to-tex-") as folder:
+        with open(os.path.join(folder, "document.tex"), "w") as f:
+            f.write(doc)
+
+        if engine == "tectonic":
+            command = ["tectonic", "--untrusted", "--outdir", folder, "document.tex"]
+        else:
+            command = [engine, "-interaction=nonstopmode", "-halt-on-error", "-no-shell-escape", "document.tex"]
+        try:
+            result = subprocess.run(command, cwd=folder, capture_output=True, text=True, errors="replace", timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return [f"{engine} did not finish compiling within {timeout} seconds"]
+        if result.returncode == 0:
+            return []
+
+        log_path = os.path.join(folder, "document.log")
+        if engine != "tectonic" and os.path.exists(log_path):
+            with open(log_path, errors="replace") as f:
+                log = f.read()
+        else:
+            log = result.stdout + result.stderr
+
+    return _log_errors(log) or [f"{engine} exited with status {result.returncode}"]
+
+def _log_errors(log: str) -> list[str]:
+    # TeX reports errors as "! message" followed, a few lines later, by "l.<line> <context>"
+    errors = []
+    lines = log.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("!") or line.startswith("error:"):
+            context = next((l for l in lines[i + 1:i + 8] if re.match(r"l\.\d+", l)), "")
+            errors.append(f"{line} {context}".strip())
+            if len(errors) >= MAX_ERRORS:
+                break
+    return errors
+
+def validate(doc: str, compile_check: bool = False, engine: str | None = None, timeout: float = COMPILE_TIMEOUT) -> list[str]:
+    """
+    Return the errors found in the document: structural and package errors, then (if compile_check is
+    set and those passed) errors from compiling it.
+    """
+    errors = structural_errors(doc) + package_errors(doc)
+    if not errors and compile_check:
+        errors = compile_errors(doc, engine=engine, timeout=timeout)
+    return errors